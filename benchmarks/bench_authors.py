@@ -0,0 +1,49 @@
+"""
+Per-entry cost of formatting authors into BibTeX.
+
+    python -m benchmarks.bench_authors [n_entries] [n_authors]
+
+The fixture is a synthetic library where authors recur across entries,
+as in a real one; about a fifth of the names carry a particle.
+"""
+from random import Random
+from time import perf_counter
+import sys
+
+from papnt.prop2entry import _extr_authors_asbib, _format_author, PREPOSITIONS
+
+
+FIRSTNAMES = ['Ada', 'Jan', 'Maria', 'J.', 'Hans', 'Li', 'Ana Maria', 'Otto']
+LASTNAMES = ['Smith', 'Berg', 'Souza', 'Fontaine', 'Wei', 'Garcia-Lopez',
+             'Heide', 'Rovere', 'Nakamura', 'Okafor']
+
+
+def make_library(n_entries: int, n_authors: int, n_people: int=5000,
+                 seed: int=0) -> list:
+    random = Random(seed)
+    people = []
+    for i in range(n_people):
+        name = random.choice(FIRSTNAMES)
+        if random.random() < .2:
+            name += ' ' + random.choice(PREPOSITIONS)
+        people.append(f'{name} {random.choice(LASTNAMES)}{i}')
+    return [[{'name': name} for name in random.sample(people, n_authors)]
+            for _ in range(n_entries)]
+
+
+def measure(library: list) -> float:
+    """Returns microseconds per entry"""
+    start = perf_counter()
+    for authors in library:
+        _extr_authors_asbib(authors)
+    return (perf_counter() - start) / len(library) * 1e6
+
+
+if __name__ == '__main__':
+    n_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_authors = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    library = make_library(n_entries, n_authors)
+    _format_author.cache_clear()
+    print(f'{n_entries} entries x {n_authors} authors')
+    print(f'cold memo: {measure(library):8.1f} us/entry')
+    print(f'warm memo: {measure(library):8.1f} us/entry')
@@ -0,0 +1,216 @@
+"""
+End-to-end throughput of `papnt paths`, `doi`, `pdf` and `makebib`
+against the local stand-ins of Notion, Crossref and GROBID in fakes.py.
+
+    python -m benchmarks.bench_e2e [--sizes 10,100,1000] [--latency-ms 0]
+        [--rate-limit-every 0] [--notion-rate 0] [--commands paths,doi,...]
+        [--profile]
+
+Each run starts from empty servers and caches, and calls what the
+command calls after parsing its arguments. --notion-rate 0 lifts the
+limit of 3 requests/sec, so that the time is spent in papnt itself.
+makebib is run twice; the second run is served from the BibTeX cache.
+--profile shows latencies per stage, as `papnt --profile` writes them.
+Journal abbreviations are not made, as iso4 needs WordNet online.
+"""
+from typing import Callable, Dict
+from argparse import ArgumentParser
+from contextlib import ExitStack
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from pathlib import Path
+from unittest.mock import patch
+import contextlib
+import logging
+import io
+
+import tomli_w
+
+from papnt import misc, mainfunc, notionprop, pdf2text, trace
+from papnt.cache import DiskCache
+from papnt.database import NotionDatabase
+from papnt.mirror import LocalMirror
+from papnt.dedup import DedupIndex
+from papnt.notionprop import CitekeyIndex, to_notionprop
+from papnt.ratelimit import TokenBucket, NOTION_RATE
+
+from .fakes import (
+    FakeNotion, FakeCrossref, FakeGrobid, crossref_at, make_pdf,
+    fake_work, template_config, FAKE_DATABASE_ID)
+
+
+COMMANDS = ('paths', 'doi', 'pdf', 'makebib')
+TARGET = 'bench'
+
+
+def _doi(i: int) -> str:
+    return f'10.5555/bench.{i:05d}'
+
+
+class Bench:
+    """Fake servers, caches and config of one run"""
+    def __init__(self, dir_temp: Path, latency: float, rate_limit_every: int,
+                 notion_rate: float):
+        self.dir = dir_temp
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.notion_rate = notion_rate
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        enter = self._stack.enter_context
+        self.notion = enter(FakeNotion(self.latency, self.rate_limit_every))
+        self.crossref = enter(FakeCrossref(self.latency))
+        self.grobid = enter(FakeGrobid(self.latency))
+        enter(crossref_at(self.crossref.url))
+
+        self.config = template_config() | {
+            'database': {'tokenkey': 'token', 'database_id': FAKE_DATABASE_ID},
+            'grobid': {'server': self.grobid.url, 'n_parallel': 4}}
+        load_path_config = self.dir / 'config.toml'
+        load_path_config.write_text(tomli_w.dumps(self.config))
+        dir_cache = self.dir / 'cache'
+        enter(patch.object(misc, 'LOAD_PATH_CONFIG', load_path_config))
+        for module, name, subdir in (
+                (notionprop, 'METADATA_CACHE', 'metadata'),
+                (pdf2text, 'GROBID_CACHE', 'grobid'),
+                (mainfunc, 'BIBTEX_CACHE', 'bibtex')):
+            enter(patch.object(module, name, DiskCache(dir_cache / subdir)))
+        enter(contextlib.redirect_stdout(io.StringIO()))  # Progress lines
+        logging.getLogger('httpx').setLevel(logging.WARNING)  # Every request
+
+        rate = self.notion_rate or 1e9
+        self.database = NotionDatabase(
+            'token', FAKE_DATABASE_ID, DiskCache(dir_cache / 'schema'),
+            base_url=self.notion.url, bucket=TokenBucket(rate, rate))
+        self.mirror = LocalMirror(dir_cache / 'mirror.sqlite')
+        return self
+
+    def __exit__(self, *args):
+        self._stack.close()
+
+    @property
+    def propnames(self) -> Dict:
+        return self.config['propnames']
+
+    def citekeys(self) -> CitekeyIndex:
+        return CitekeyIndex.from_mirror(self.mirror, self.propnames['id'])
+
+    # -- vvv Fixtures and commands vvv ---
+
+    def prepare_paths(self, n_records: int):
+        self.dir_pdf = self.dir / 'pdf'
+        self.dir_pdf.mkdir()
+        for i in range(n_records):
+            make_pdf(self.dir_pdf / f'{i:05d}.pdf', _doi(i))
+
+    def run_paths(self):
+        index = DedupIndex(self.mirror, self.propnames['doi'])
+        index.seed(self.database)
+        mainfunc.add_records_from_local_pdfpath(
+            self.database, self.propnames, (self.dir_pdf,), index, False,
+            self.citekeys())
+
+    def prepare_doi(self, n_records: int):
+        for i in range(n_records):
+            self.notion.add_page({
+                'Name': to_notionprop('', 'title'),
+                'DOI': to_notionprop(_doi(i), 'rich_text')})
+
+    def run_doi(self):
+        self.mirror.sync(self.database)
+        mainfunc.update_unchecked_records_from_doi(
+            self.database, self.propnames, None, self.citekeys())
+
+    def prepare_pdf(self, n_records: int):
+        self.prepare_paths(n_records)
+        for load_path_pdf in sorted(self.dir_pdf.glob('*.pdf')):
+            url = self.notion.add_file(load_path_pdf.read_bytes())
+            self.notion.add_page({
+                'Name': to_notionprop('', 'title'),
+                'PDF': {'files': [{'name': load_path_pdf.name,
+                                   'type': 'file', 'file': {'url': url}}]}})
+
+    def run_pdf(self):
+        self.mirror.sync(self.database)
+        mainfunc.update_unchecked_records_from_uploadedpdf(
+            self.database, self.propnames, None, self.citekeys())
+
+    def prepare_makebib(self, n_records: int):
+        maker = notionprop.NotionPropMaker()
+        for i in range(n_records):
+            # Same properties as papnt makes from the DOI
+            prop = maker._make_properties(fake_work(_doi(i)), self.propnames)
+            self.notion.add_page(prop | {
+                'Cite in': to_notionprop([TARGET], 'multi_select'),
+                'info': {'checkbox': True}})
+
+    def run_makebib(self):
+        mainfunc.make_bibfiles_from_records(
+            self.database, [TARGET], self.propnames, self.dir)
+
+
+def measure(command: str, n_records: int, **kwargs) -> Dict:
+    with TemporaryDirectory() as dir_temp, \
+         Bench(Path(dir_temp), **kwargs) as bench, \
+         patch.object(trace, 'TRACER', trace.Tracer()):
+        getattr(bench, f'prepare_{command}')(n_records)
+        run: Callable = getattr(bench, f'run_{command}')
+        n_requests = sum(bench.notion.counts.values())
+        trace.TRACER.enable()
+        start = perf_counter()
+        run()
+        result = {'elapsed': perf_counter() - start,
+                  'trace': trace.TRACER.report()}
+        if command == 'makebib':
+            start = perf_counter()
+            run()
+            result['elapsed_cached'] = perf_counter() - start
+        n_unchecked = sum(not page['properties']['info']['checkbox']
+                          for page in bench.notion.pages.values())
+        if n_unchecked:
+            raise RuntimeError(f'{n_unchecked} of {n_records} records '
+                               f'were left unchecked by {command}.')
+        result['notion'] = sum(bench.notion.counts.values()) - n_requests
+        result['counters'] = bench.database.notion.counters
+        return result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', default='10,100,1000')
+    parser.add_argument('--commands', default=','.join(COMMANDS))
+    parser.add_argument('--latency-ms', type=float, default=0.)
+    parser.add_argument('--rate-limit-every', type=int, default=0)
+    parser.add_argument('--notion-rate', type=float, default=0.,
+                        help=f'requests/sec, Notion allows {NOTION_RATE:g}')
+    parser.add_argument('--profile', action='store_true')
+    args = parser.parse_args()
+
+    print(f'{"command":8s} {"records":>7s} {"sec":>8s} {"records/s":>9s} '
+          f'{"requests":>8s} {"retries":>7s} {"429":>5s}')
+    for command in args.commands.split(','):
+        for n_records in map(int, args.sizes.split(',')):
+            result = measure(
+                command, n_records, latency=args.latency_ms / 1000,
+                rate_limit_every=args.rate_limit_every,
+                notion_rate=args.notion_rate)
+            counters = result['counters']
+            print(f'{command:8s} {n_records:7d} {result["elapsed"]:8.2f} '
+                  f'{n_records / result["elapsed"]:9.1f} '
+                  f'{result["notion"]:8d} {counters["retries"]:7d} '
+                  f'{counters["rate_limited"]:5d}')
+            if args.profile:
+                for stage, stats in result['trace']['stages'].items():
+                    print(f'  {stage:14s} n={stats["count"]:<5d} '
+                          f'p50={stats["p50"] * 1e3:8.2f} ms '
+                          f'p95={stats["p95"] * 1e3:8.2f} ms '
+                          f'total={stats["total"]:7.2f} s')
+            if 'elapsed_cached' in result:
+                elapsed = result['elapsed_cached']
+                print(f'{"(cached)":8s} {n_records:7d} {elapsed:8.2f} '
+                      f'{n_records / elapsed:9.1f}')
+
+
+if __name__ == '__main__':
+    main()
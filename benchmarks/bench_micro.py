@@ -0,0 +1,75 @@
+"""
+Microbenchmarks of converting GROBID output into Notion blocks and
+Notion properties into BibTeX entries.
+
+    python -m benchmarks.bench_micro [n_repeats]
+
+pdf2children is measured against FakeGrobid, with an empty cache (a
+request and conversion per PDF) and with the cache filled by that run.
+"""
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from pathlib import Path
+import logging
+import sys
+
+from papnt.cache import DiskCache
+from papnt.pdf2text import tei2children, pdf2children, PDF2ChildrenConverter
+from papnt.prop2entry import notionprop_to_entry
+from papnt.notionprop import NotionPropMaker
+
+from .fakes import (
+    FakeNotion, FakeGrobid, DIR_TEI, fake_work, make_pdf, template_config)
+
+
+def _per_call(func, args_list: list) -> float:
+    """Returns microseconds per call"""
+    start = perf_counter()
+    for args in args_list:
+        func(*args)
+    return (perf_counter() - start) / len(args_list) * 1e6
+
+
+def bench_tei2children(n_repeats: int):
+    for load_path_tei in sorted(DIR_TEI.glob('*.tei.xml')):
+        xmltext = load_path_tei.read_text()
+        elapsed = _per_call(tei2children, [(xmltext,)] * n_repeats)
+        print(f'tei2children {load_path_tei.name:18s} {elapsed:9.1f} us')
+
+
+def bench_pdf2children(n_pdfs: int):
+    with TemporaryDirectory() as dir_temp, FakeGrobid() as grobid:
+        dir_temp = Path(dir_temp)
+        load_paths_pdf = [make_pdf(dir_temp / f'{i}.pdf', f'10.5555/{i}')
+                          for i in range(n_pdfs)]
+        client = PDF2ChildrenConverter(grobid.url).client
+        cache = DiskCache(dir_temp / 'cache', compress=True)
+        args_list = [(client, path, cache) for path in load_paths_pdf]
+        for label in ('cold', 'cached'):
+            elapsed = _per_call(pdf2children, args_list)
+            print(f'pdf2children {label:18s} {elapsed:9.1f} us')
+
+
+def bench_notionprop_to_entry(n_records: int):
+    propnames = template_config()['propnames']
+    maker, notion = NotionPropMaker(), FakeNotion()
+    propname_to_bibname = {val: key for key, val in propnames.items()}
+    args_list = []
+    for i in range(n_records):
+        prop = maker._make_properties(
+            fake_work(f'10.5555/bench.{i:05d}'), propnames)
+        args_list.append(
+            (notion.add_page(prop)['properties'], propname_to_bibname))
+    elapsed = _per_call(notionprop_to_entry, args_list)
+    print(f'notionprop_to_entry {"":11s} {elapsed:9.1f} us')
+
+
+def main(n_repeats: int=100):
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    bench_tei2children(n_repeats)
+    bench_pdf2children(n_repeats)
+    bench_notionprop_to_entry(n_repeats * 10)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,78 @@
+"""
+Startup time of the papnt command, in fresh interpreters.
+
+    python -m benchmarks.bench_startup [n_runs]
+
+Each case is run n_runs times and its best time is compared with the
+budget; the command fails if a case is over budget. CLI cases run the
+command itself; subcommand cases import what the subcommand imports
+before it starts working, so that no token or server is needed.
+Cases showing the version are skipped unless papnt is installed.
+"""
+from time import perf_counter
+import importlib.metadata
+import subprocess
+import sys
+
+
+RUN_CLI = 'import sys; from papnt.cli import main; main(sys.argv[1:])'
+
+# (name, python code, arguments, budget in sec, including the interpreter)
+CASES = [
+    ('python', 'pass', [], None),
+    ('papnt', RUN_CLI, [], .3),
+    ('papnt --version', RUN_CLI, ['--version'], .3),
+    ('papnt --help', RUN_CLI, ['--help'], .3),
+    *[(f'papnt {command} --help', RUN_CLI, [command, '--help'], .3)
+      for command in ('paths', 'doi', 'pdf', 'makebib', 'sync')],
+    ('paths', 'import papnt.cli, papnt.dedup, papnt.database, '
+              'papnt.pdf2text, papnt.pdf2doi, papnt.notionprop', [], 1.8),
+    ('doi', 'import papnt.cli, papnt.database, papnt.mirror, '
+            'papnt.notionprop; papnt.notionprop.NotionPropMaker', [], .8),
+    ('pdf', 'import papnt.cli, papnt.database, papnt.mirror, requests, '
+            'papnt.pdf2text, papnt.pdf2doi, papnt.notionprop', [], 1.8),
+    ('makebib --local', 'import papnt.cli, papnt.mirror, papnt.prop2entry, '
+                        'papnt.abbrlister, bibtexparser.bwriter', [], .5),
+    ('sync', 'import papnt.cli, papnt.database, papnt.mirror', [], .5),
+]
+
+
+def measure(code: str, args: list, n_runs: int) -> float:
+    """Returns the best wall time of n_runs in sec"""
+    elapsed = []
+    for _ in range(n_runs):
+        start = perf_counter()
+        subprocess.run([sys.executable, '-c', code, *args], check=True,
+                       stdout=subprocess.DEVNULL)
+        elapsed.append(perf_counter() - start)
+    return min(elapsed)
+
+
+def _is_installed() -> bool:
+    try:
+        importlib.metadata.version('papnt')
+        return True
+    except importlib.metadata.PackageNotFoundError:
+        return False
+
+
+def main(n_runs: int=5) -> bool:
+    """Returns True if every case is within its budget"""
+    is_within_budget = True
+    needs_version = ('papnt', 'papnt --version')
+    cases = CASES if _is_installed() else \
+        [case for case in CASES if case[0] not in needs_version]
+    for name, code, args, budget in cases:
+        elapsed = measure(code, args, n_runs)
+        if budget is None:
+            print(f'{name:24s} {elapsed * 1e3:7.1f} ms')
+            continue
+        is_within_budget &= (elapsed <= budget)
+        status = 'ok' if elapsed <= budget else 'OVER BUDGET'
+        print(f'{name:24s} {elapsed * 1e3:7.1f} ms '
+              f'(budget {budget * 1e3:.0f} ms) {status}')
+    return is_within_budget
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(*map(int, sys.argv[1:2])) else 1)
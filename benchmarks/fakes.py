@@ -0,0 +1,506 @@
+"""
+Local stand-ins of Notion, Crossref and GROBID serving canned fixtures,
+with configurable latency and injected 429 responses.
+
+    with FakeNotion() as notion, FakeCrossref() as crossref, \\
+         FakeGrobid() as grobid, crossref_at(crossref.url):
+        database = NotionDatabase('token', FAKE_DATABASE_ID,
+                                  base_url=notion.url)
+
+Only the endpoints and filters papnt uses are implemented.
+"""
+from typing import Dict, List, Optional, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.parser import BytesParser
+from email.policy import HTTP
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from hashlib import sha1
+from threading import Lock, Thread
+from unittest.mock import patch
+from pathlib import Path
+from time import sleep
+import tomllib
+import json
+import re
+import uuid
+
+
+FAKE_DATABASE_ID = 'fake-database'
+FAKE_DATA_SOURCE_ID = 'fake-data-source'
+DIR_TEI = Path(__file__).parents[1] / 'tests/testdata/tei'
+
+# Properties of the database; propnames of config_template.toml and those
+# NotionPropMaker fills without propnames
+FAKE_SCHEMA = {
+    'Name': 'title', 'DOI': 'rich_text', 'Authors': 'multi_select',
+    'Title': 'rich_text', 'Edition': 'rich_text', 'Year': 'number',
+    'Journal': 'select', 'Volume': 'rich_text', 'Pages': 'rich_text',
+    'Publisher': 'select', 'Citekey': 'rich_text', 'Type': 'select',
+    'HowPublished': 'rich_text', 'Cite in': 'multi_select', 'PDF': 'files',
+    'First': 'select', 'Issue': 'rich_text', 'Subject': 'multi_select',
+    'info': 'checkbox'}
+
+FAMILY_NAMES = ['Smith', 'van der Berg', 'Souza', 'Fontaine', 'Wei',
+                'Garcia-Lopez', 'Heide', 'Rovere', 'Nakamura', 'Okafor']
+GIVEN_NAMES = ['Ada', 'Jan', 'Maria', 'J.', 'Hans', 'Li', 'Ana Maria']
+TITLE_WORDS = ['interoceptive', 'prediction', 'of', 'the', 'emotional',
+               'awareness', 'in', 'neural', 'networks', 'a', 'bayesian',
+               'model', 'for', 'visual', 'cortex']
+JOURNALS = ['PLOS ONE', 'Neural Networks', 'Scientific Reports',
+            'Nature Reviews Neuroscience']
+
+
+def template_config() -> Dict:
+    """Config of a new user, as papnt makes from config_template.toml"""
+    load_path_template = Path(__file__).parents[1] / \
+        'papnt/config_template.toml'
+    return tomllib.loads(load_path_template.read_text())
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds'
+                                                ).replace('+00:00', 'Z')
+
+
+class FakeServer:
+    """
+    HTTP server on localhost, running in a background thread while used
+    as a context manager.
+    latency: sec added to every response
+    rate_limit_every: every n-th request is answered 429 (0 for never)
+    retry_after: sec, sent with 429 as Retry-After
+    """
+    def __init__(self, latency: float=0., rate_limit_every: int=0,
+                 retry_after: float=.1):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.counts = Counter()  # Requests by route, 429s as 'rate_limited'
+        self._n_requests = 0
+        self._lock = Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, as the real ones
+            # Headers and body are written apart; do not wait for ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server._dispatch(self)
+
+            do_POST = do_PATCH = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method: str, path: str, headers, body: bytes
+               ) -> Tuple[int, Dict[str, str], bytes]:
+        """Returns (status, headers, body) of the response"""
+        raise NotImplementedError
+
+    def rate_limited(self) -> Tuple[int, Dict[str, str], bytes]:
+        return 429, {'Retry-After': str(self.retry_after)}, b''
+
+    def is_limited(self, path: str) -> bool:
+        """Whether requests to path count toward rate_limit_every"""
+        return True
+
+    def _dispatch(self, request: BaseHTTPRequestHandler):
+        body = _read_body(request)
+        is_rate_limited = False
+        if self.rate_limit_every and self.is_limited(request.path):
+            with self._lock:
+                self._n_requests += 1
+                is_rate_limited = \
+                    (self._n_requests % self.rate_limit_every == 0)
+        if self.latency:
+            sleep(self.latency)
+        if is_rate_limited:
+            self.counts['rate_limited'] += 1
+            status, headers, body = self.rate_limited()
+        else:
+            status, headers, body = self.handle(
+                request.command, request.path, request.headers, body)
+        request.send_response(status)
+        for key, value in headers.items():
+            request.send_header(key, value)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def _read_body(request: BaseHTTPRequestHandler) -> bytes:
+    if 'chunked' in request.headers.get('Transfer-Encoding', ''):
+        body = b''
+        while size := int(request.rfile.readline().strip(), 16):
+            body += request.rfile.read(size)
+            request.rfile.readline()
+        request.rfile.readline()
+        return body
+    return request.rfile.read(int(request.headers.get('Content-Length', 0)))
+
+
+def _json_response(status: int, content) -> Tuple[int, Dict, bytes]:
+    return (status, {'Content-Type': 'application/json'},
+            json.dumps(content).encode())
+
+
+def _form_files(headers, body: bytes) -> Dict[str, bytes]:
+    """Files in multipart/form-data by field name"""
+    message = BytesParser(policy=HTTP).parsebytes(
+        b'Content-Type: ' + headers['Content-Type'].encode() +
+        b'\r\n\r\n' + body)
+    return {part.get_param('name', header='content-disposition'):
+            part.get_payload(decode=True) for part in message.iter_parts()}
+
+
+# -- vvv Notion vvv ---
+
+def _plain_text(prop: Dict) -> str:
+    return ''.join(text['plain_text'] for text in prop[prop['type']] or [])
+
+
+def _matches(page: Dict, filter: Optional[Dict]) -> bool:
+    """The subset of Notion filter papnt sends"""
+    if not filter:
+        return True
+    if 'and' in filter:
+        return all(_matches(page, filter_) for filter_ in filter['and'])
+    if 'or' in filter:
+        return any(_matches(page, filter_) for filter_ in filter['or'])
+    if filter.get('timestamp') == 'last_edited_time':
+        (key, value), = filter['last_edited_time'].items()
+        edited = page['last_edited_time']
+        return {'on_or_after': edited >= value, 'after': edited > value,
+                'on_or_before': edited <= value, 'before': edited < value
+                }[key]
+    prop = page['properties'][filter['property']]
+    proptype = next(key for key in filter if key != 'property')
+    (key, value), = filter[proptype].items()
+    content = prop[prop['type']]
+    match key:
+        case 'equals' if proptype == 'checkbox':
+            return content == value
+        case 'equals' if proptype == 'select':
+            return (content or {}).get('name') == value
+        case 'equals':
+            return _plain_text(prop) == value
+        case 'is_empty':
+            return not content
+        case 'is_not_empty':
+            return bool(content)
+        case 'contains' if proptype == 'multi_select':
+            return value in [option['name'] for option in content]
+        case 'does_not_contain' if proptype == 'multi_select':
+            return value not in [option['name'] for option in content]
+        case 'contains':
+            return value in _plain_text(prop)
+    raise NotImplementedError(f'Unsupported filter: {filter}')
+
+
+class FakeNotion(FakeServer):
+    """
+    Notion API keeping pages in memory. Files uploaded, and those added
+    by add_file(), are served from /files/{id}.
+    Query cursors are IDs of pages, as in Notion. offset_cursors makes
+    them offsets in the matching pages, which skip pages when earlier
+    ones drop out of the filter between requests.
+    """
+    PAGE_SIZE = 100
+    MAX_LEN_CHILDREN = 100
+
+    def __init__(self, *args, schema: Optional[Dict[str, str]]=None,
+                 offset_cursors: bool=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.schema = schema or FAKE_SCHEMA
+        self.offset_cursors = offset_cursors
+        self.pages: Dict[str, Dict] = {}  # In order of creation
+        self.children: Dict[str, List[Dict]] = {}
+        self.files: Dict[str, bytes] = {}
+        self._lock_pages = Lock()
+
+    def rate_limited(self):
+        status, headers, body = _json_response(429, {
+            'object': 'error', 'status': 429, 'code': 'rate_limited',
+            'message': 'You have been rate limited.'})
+        return status, headers | {'Retry-After': str(self.retry_after)}, body
+
+    def is_limited(self, path: str) -> bool:
+        return not path.startswith('/files/')  # Hosted apart from the API
+
+    def add_file(self, content: bytes) -> str:
+        """Returns URL of the file, as of those hosted by Notion"""
+        file_id = str(uuid.uuid4())
+        self.files[file_id] = content
+        return f'{self.url}/files/{file_id}'
+
+    def add_page(self, properties: Dict) -> Dict:
+        """Add a page directly, e.g. as a fixture. properties are in the
+        form of requests to Notion, except files given as in responses."""
+        with self._lock_pages:
+            return self._create(properties)
+
+    def _error(self, status: int, code: str, message: str):
+        return _json_response(status, {'object': 'error', 'status': status,
+                                       'code': code, 'message': message})
+
+    def handle(self, method, path, headers, body):
+        path = path.split('?')[0].strip('/')
+        route = re.sub(r'/[^/]*?-[^/]*', '/{id}', path)
+        self.counts[f'{method} {route}'] += 1
+        if path.startswith('files/'):
+            content = self.files.get(path.split('/')[1])
+            if content is None:
+                return 404, {}, b''
+            return 200, {'Content-Type': 'application/pdf'}, content
+        if path.endswith('/send'):
+            return self._send_file(path.split('/')[2], headers, body)
+        request = json.loads(body) if body else {}
+        with self._lock_pages:
+            try:
+                return self._handle_json(method, path.split('/')[1:], request)
+            except (KeyError, ValueError) as e:
+                return self._error(400, 'validation_error', repr(e))
+
+    def _handle_json(self, method: str, parts: List[str], request: Dict):
+        match method, parts:
+            case 'GET', ['databases', database_id]:
+                return _json_response(200, {
+                    'object': 'database', 'id': database_id,
+                    'data_sources': [{'id': FAKE_DATA_SOURCE_ID,
+                                      'name': 'Fake'}]})
+            case 'GET', ['data_sources', _]:
+                return _json_response(200, {
+                    'object': 'data_source', 'id': FAKE_DATA_SOURCE_ID,
+                    'properties': {
+                        name: {'id': name, 'name': name, 'type': proptype}
+                        for name, proptype in self.schema.items()}})
+            case 'POST', ['data_sources', _, 'query']:
+                return _json_response(200, self._query(request))
+            case 'POST', ['pages']:
+                page = self._create(request['properties'])
+                self._append(page['id'], request.get('children', []))
+                return _json_response(200, page)
+            case 'GET', ['pages', page_id]:
+                return _json_response(200, self.pages[page_id])
+            case 'PATCH', ['pages', page_id]:
+                page = self.pages[page_id]
+                page['properties'] |= self._to_response(request['properties'])
+                page['last_edited_time'] = _now()
+                return _json_response(200, page)
+            case 'PATCH', ['blocks', block_id, 'children']:
+                return _json_response(200, {'object': 'list', 'results':
+                    self._append(block_id, request['children'])})
+            case 'POST', ['file_uploads']:
+                file_id = str(uuid.uuid4())
+                return _json_response(200, {
+                    'object': 'file_upload', 'id': file_id,
+                    'status': 'pending', 'filename': request.get('filename'),
+                    'number_of_parts': request.get('number_of_parts')})
+            case 'POST', ['file_uploads', file_id, 'complete']:
+                return _json_response(200, {
+                    'object': 'file_upload', 'id': file_id,
+                    'status': 'uploaded'})
+        return self._error(404, 'object_not_found', '/'.join(parts))
+
+    def _send_file(self, file_id: str, headers, body: bytes):
+        part = _form_files(headers, body)['file']
+        with self._lock_pages:
+            self.files[file_id] = self.files.get(file_id, b'') + part
+        return _json_response(200, {'object': 'file_upload', 'id': file_id,
+                                    'status': 'uploaded'})
+
+    def _query(self, request: Dict) -> Dict:
+        page_size = min(request.get('page_size', self.PAGE_SIZE),
+                        self.PAGE_SIZE)
+        pages = list(self.pages.values())
+        cursor = request.get('start_cursor')
+        if self.offset_cursors:
+            pages = [page for page in pages
+                     if _matches(page, request.get('filter'))]
+            start = int(cursor or 0)
+            end = start + page_size
+            return {'object': 'list', 'results': pages[start:end],
+                    'has_more': end < len(pages),
+                    'next_cursor': str(end) if end < len(pages) else None}
+        # From the page of the cursor, whether it still matches or not
+        start = list(self.pages).index(cursor) if cursor else 0
+        results = []
+        for page in pages[start:]:
+            if not _matches(page, request.get('filter')):
+                continue
+            if len(results) == page_size:
+                return {'object': 'list', 'results': results,
+                        'has_more': True, 'next_cursor': page['id']}
+            results.append(page)
+        return {'object': 'list', 'results': results, 'has_more': False,
+                'next_cursor': None}
+
+    def _create(self, properties: Dict) -> Dict:
+        page_id = str(uuid.uuid4())
+        empty = {'title': [], 'rich_text': [], 'multi_select': [],
+                 'select': None, 'number': None, 'checkbox': False,
+                 'files': [], 'date': None}
+        page = {
+            'object': 'page', 'id': page_id,
+            'created_time': _now(), 'last_edited_time': _now(),
+            'archived': False, 'in_trash': False,
+            'parent': {'type': 'data_source_id',
+                       'data_source_id': FAKE_DATA_SOURCE_ID},
+            'properties': {
+                name: {'id': name, 'type': proptype,
+                       proptype: empty[proptype]}
+                for name, proptype in self.schema.items()}}
+        page['properties'] |= self._to_response(properties)
+        self.pages[page_id] = page
+        self.children[page_id] = []
+        return page
+
+    def _to_response(self, properties: Dict) -> Dict:
+        """Property values in requests into those in responses"""
+        response = {}
+        for name, value in properties.items():
+            proptype = self.schema[name]
+            content = value[proptype]
+            if proptype in ('title', 'rich_text'):
+                content = [{'type': 'text', 'annotations': {}, 'href': None,
+                            'text': text['text'],
+                            'plain_text': text['text']['content']}
+                           for text in content]
+            elif proptype == 'multi_select':
+                content = [{'id': option['name'], 'name': option['name'],
+                            'color': 'default'} for option in content]
+            elif proptype == 'files':
+                content = [self._to_file(file) for file in content]
+            response[name] = {'id': name, 'type': proptype,
+                              proptype: content}
+        return response
+
+    def _to_file(self, file: Dict) -> Dict:
+        if file['type'] != 'file_upload':
+            return file
+        file_id = file['file_upload']['id']
+        if file_id not in self.files:
+            raise ValueError(f'File upload not found: {file_id}')
+        return {'name': file.get('name', file_id), 'type': 'file',
+                'file': {'url': f'{self.url}/files/{file_id}',
+                         'expiry_time': _now()}}
+
+    def _append(self, block_id: str, children: List[Dict]) -> List[Dict]:
+        if len(children) > self.MAX_LEN_CHILDREN:
+            raise ValueError(f'body.children.length should be ≤ '
+                             f'{self.MAX_LEN_CHILDREN}')
+        self.children[block_id].extend(children)
+        return children
+
+
+# -- vvv Crossref vvv ---
+
+def fake_work(doi: str) -> Dict:
+    """Crossref work of the DOI, made up from the DOI itself"""
+    seed = int(sha1(doi.lower().encode()).hexdigest(), 16)
+
+    def pick(choices: List, n_shift: int):
+        return choices[(seed >> n_shift) % len(choices)]
+
+    n_authors = 1 + (seed % 6)
+    title = ' '.join(pick(TITLE_WORDS, 4 * i) for i in range(8)).capitalize()
+    return {
+        'DOI': doi, 'type': 'journal-article', 'title': [title],
+        'author': [{'given': pick(GIVEN_NAMES, 3 * i + 1),
+                    'family': pick(FAMILY_NAMES, 5 * i + 2), 'sequence':
+                    'first' if i == 0 else 'additional'}
+                   for i in range(n_authors)],
+        'published': {'date-parts': [[1990 + (seed % 35), 1 + (seed % 12)]]},
+        'container-title': [pick(JOURNALS, 7)],
+        'volume': str(seed % 300), 'issue': str(seed % 12),
+        'page': f'{seed % 900}-{seed % 900 + 12}',
+        'publisher': 'Fake Publisher', 'subject': ['Neuroscience']}
+
+
+class FakeCrossref(FakeServer):
+    """
+    Crossref REST API serving works/{doi} made up by fake_work().
+    DOIs starting with unknown_prefix are answered 404.
+    """
+    def __init__(self, *args, unknown_prefix: str='10.0000/', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unknown_prefix = unknown_prefix
+
+    def handle(self, method, path, headers, body):
+        self.counts[f'{method} works'] += 1
+        match = re.match(r'^/works/(.+)$', path.split('?')[0])
+        if not (method == 'GET' and match):
+            return 404, {}, b'Resource not found.'
+        doi = match[1]
+        if doi.startswith(self.unknown_prefix):
+            return 404, {}, b'Resource not found.'
+        status, headers, body = _json_response(200, {
+            'status': 'ok', 'message-type': 'work',
+            'message': fake_work(doi)})
+        return status, headers | {'X-Rate-Limit-Limit': '50',
+                                  'X-Rate-Limit-Interval': '1s'}, body
+
+
+@contextmanager
+def crossref_at(url: str):
+    """Send requests of crossref.restful to url instead of Crossref"""
+    def build_url_endpoint(endpoint, context=None):
+        return '/'.join([url] + [part for part in (context, endpoint)
+                                 if part])
+
+    with patch('crossref.restful.build_url_endpoint', build_url_endpoint):
+        yield
+
+
+# -- vvv GROBID vvv ---
+
+class FakeGrobid(FakeServer):
+    """GROBID answering every PDF with the same TEI"""
+    def __init__(self, *args, load_path_tei: Path=DIR_TEI / 'article.tei.xml',
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tei = Path(load_path_tei).read_bytes()
+
+    def handle(self, method, path, headers, body):
+        service = path.split('?')[0].removeprefix('/api/')
+        self.counts[f'{method} {service}'] += 1
+        if service == 'isalive':
+            return 200, {'Content-Type': 'text/plain'}, b'true'
+        if service == 'processFulltextDocument' and method == 'POST':
+            return 200, {'Content-Type': 'application/xml'}, self.tei
+        return 404, {}, b''
+
+
+# -- vvv Fixtures vvv ---
+
+def make_pdf(save_path_pdf: Path, doi: str) -> Path:
+    """Small PDF with the DOI in its metadata and first page"""
+    import pymupdf
+    work = fake_work(doi)
+    with pymupdf.open() as document:
+        page = document.new_page()
+        page.insert_text((72, 72), work['title'][0])
+        page.insert_text((72, 96), f'https://doi.org/{doi}')
+        document.set_metadata({'title': work['title'][0],
+                               'subject': f'doi:{doi}'})
+        document.save(save_path_pdf)
+    return save_path_pdf
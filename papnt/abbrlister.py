@@ -1,27 +1,63 @@
+from typing import Iterable, Optional
+from pathlib import Path
+from threading import Lock
 import json
 
 from bibtexparser import loads
 from bibtexparser.bparser import BibTexParser
-from iso4 import abbreviate
-import nltk
 
+from .misc import write_if_changed, DIR_CACHE
+from .cache import DiskCache
 
-def _remove_duplicated_space(dict_: dict):
-    return {k: v.replace('  ', ' ') for k, v in dict_.items()}
+
+ABBR_CACHE = DiskCache(DIR_CACHE / 'abbr')  # ISO 4 abbreviation by journal
+_LOCK_WORDNET = Lock()
+_wordnet_is_ready = False
+
+
+def _prepare_wordnet():
+    """iso4 lemmatizes words with WordNet; download it only if missing"""
+    global _wordnet_is_ready
+    with _LOCK_WORDNET:
+        if _wordnet_is_ready:
+            return
+        import nltk
+        for resource in ('corpora/wordnet', 'corpora/wordnet.zip'):
+            try:
+                nltk.data.find(resource)
+                break
+            except LookupError:
+                continue
+        else:
+            nltk.download('wordnet', quiet=True)
+        _wordnet_is_ready = True
+
+
+def abbreviate_journal(name: str, cache: Optional[DiskCache]=None) -> str:
+    def abbreviate_() -> str:
+        _prepare_wordnet()
+        from iso4 import abbreviate
+        return abbreviate(name).replace('  ', ' ')
+
+    return (cache or ABBR_CACHE).get_or_fetch(name, abbreviate_)
 
 
 class AbbrLister:
-    def __init__(self, load_path_bib: str):
-        with open(load_path_bib, 'r') as f:
-            bibtext = f.read()
-        parser = BibTexParser()
-        bibdatabase = loads(bibtext, parser).entries_dict
-        names_journal = [article.get('journal')
-                         for article in bibdatabase.values()]
+    def __init__(self, bib: str | Path | Iterable[dict],
+                 cache: Optional[DiskCache]=None):
+        """
+        bib: path to BIB file, or its entries
+        cache: shared ABBR_CACHE is used by default
+        """
+        if isinstance(bib, (str, Path)):
+            with open(bib, 'r') as f:
+                bibtext = f.read()
+            parser = BibTexParser()
+            bib = loads(bibtext, parser).entries_dict.values()
+        names_journal = [entry.get('journal') for entry in bib]
         self.names_journal = sorted(list(set(
             [name for name in names_journal if name is not None])))
-
-        nltk.download('wordnet')
+        self.cache = cache or ABBR_CACHE
 
     def listup(self, spec: dict | None=None):
         """
@@ -30,10 +66,11 @@ class AbbrLister:
             {'PLOS ONE': 'PLOS ONE'}
             Case insensitive.
         """
-        abbrs = {name: abbreviate(name) for name in self.names_journal}
-        self.abbrs = _remove_duplicated_space(abbrs)
+        self.abbrs = {name: abbreviate_journal(name, self.cache)
+                      for name in self.names_journal}
         if spec is None:
             return self
+        spec = {name.lower(): abbr for name, abbr in spec.items()}
         specified_abbrs = {name: spec[name.lower()]
                            for name in self.names_journal
                            if spec.get(name.lower())}
@@ -44,11 +81,10 @@ class AbbrLister:
         if not hasattr(self, 'abbrs'):
             raise RuntimeError('Use listup() first.')
 
-        with open(save_path, 'w') as f:
-            json.dump(
-                {'default': {'container-title': self.abbrs}}, f, indent=2)
+        write_if_changed(save_path, json.dumps(
+            {'default': {'container-title': self.abbrs}}, indent=2))
 
 
 if __name__ == '__main__':
     lister = AbbrLister('/Users/issakuss/Desktop/study14.bib')
-    lister.listup().save('/Users/issakuss/Desktop/study14.json')
\ No newline at end of file
+    lister.listup().save('/Users/issakuss/Desktop/study14.json')
@@ -0,0 +1,164 @@
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+from pathlib import Path
+from hashlib import sha1, sha256
+from concurrent.futures import Future
+from threading import Lock
+from time import time
+import gzip
+import json
+import os
+
+
+_MISSING = object()
+
+
+def file_sha256(load_path: str | Path, chunk_size: int=1 << 20) -> str:
+    """Hex digest of the file content, read in chunks"""
+    hasher = sha256()
+    with open(load_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class DiskCache:
+    def __init__(self, dir_cache: str | Path, ttl: Optional[float]=None,
+                 max_entries: Optional[int]=None,
+                 negative_ttl: Optional[float]=None,
+                 max_bytes: Optional[int]=None, compress: bool=False):
+        """
+        ttl: seconds until an entry expires; None keeps entries forever
+        max_entries: least recently used entries are evicted beyond this
+        negative_ttl: ttl of None values, which record failed lookups
+        max_bytes: same as max_entries, for total size of the files
+        compress: store entries gzipped, for large values
+        """
+        self.dir_cache = Path(dir_cache)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._suffix = '.json.gz' if compress else '.json'
+        self._lock = Lock()
+        self._inflight: Dict[str, Future] = {}
+        self._usage: Optional[Tuple[int, int]] = None  # entries, bytes
+
+    def _path(self, key: str) -> Path:
+        return self.dir_cache / (sha1(key.encode()).hexdigest() + self._suffix)
+
+    def _iter_entry_paths(self) -> Iterator[Path]:
+        # Entries left in the other format, since compress was switched,
+        # are never read but still evicted, being used least recently
+        for suffix in ('.json', '.json.gz'):
+            yield from self.dir_cache.glob('*' + suffix)
+
+    def _open(self, path: Path, mode: str):
+        if self.compress:
+            return gzip.open(path, mode + 't', encoding='UTF-8')
+        return path.open(mode, encoding='UTF-8')
+
+    def get(self, key: str, default: Any=None) -> Any:
+        path = self._path(key)
+        try:
+            with self._open(path, 'r') as f:
+                item = json.load(f)
+        except (FileNotFoundError, EOFError, gzip.BadGzipFile,
+                json.JSONDecodeError):
+            return default
+        ttl = self.negative_ttl if item['value'] is None else self.ttl
+        if (ttl is not None) and (time() - item['time'] > ttl):
+            path.unlink(missing_ok=True)
+            return default
+        if self.max_entries or self.max_bytes:
+            os.utime(path)  # mtime tells when it was used last
+        return item['value']
+
+    def set(self, key: str, value: Any):
+        self.dir_cache.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        path_temp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with self._open(path_temp, 'w') as f:
+            json.dump({'key': key, 'time': time(), 'value': value}, f)
+        os.replace(path_temp, path)
+        if not (self.max_entries or self.max_bytes):
+            return
+        # Listing the directory at every write is slow for large caches,
+        # so it is done only when the running totals exceed a limit.
+        # Overwritten keys are counted twice; it only makes it earlier.
+        with self._lock:
+            if self._usage is not None:
+                n_entries, n_bytes = self._usage
+                self._usage = (n_entries + 1, n_bytes + path.stat().st_size)
+            if (self._usage is None) or self._is_over(*self._usage):
+                self._usage = self._evict()
+
+    def _is_over(self, n_entries: int, n_bytes: int, margin: float=0.
+                 ) -> bool:
+        return bool(
+            (self.max_entries and
+             n_entries > self.max_entries - int(self.max_entries * margin))
+            or (self.max_bytes and
+                n_bytes > self.max_bytes - int(self.max_bytes * margin)))
+
+    def _evict(self) -> Tuple[int, int]:
+        """Evict least recently used entries down to 90% of the limits.
+        Returns number and total size of the remaining entries."""
+        stats = []
+        for path in self._iter_entry_paths():
+            try:
+                stats.append((path, path.stat()))
+            except FileNotFoundError:  # Evicted by another process
+                continue
+        stats.sort(key=lambda item: item[1].st_mtime, reverse=True)
+        if not self._is_over(len(stats), sum(s.st_size for _, s in stats)):
+            return len(stats), sum(s.st_size for _, s in stats)
+        n_entries, n_bytes = 0, 0
+        for i, (path, stat) in enumerate(stats):
+            if self._is_over(n_entries + 1, n_bytes + stat.st_size, .1):
+                for path, _ in stats[i:]:
+                    path.unlink(missing_ok=True)
+                break
+            n_entries += 1
+            n_bytes += stat.st_size
+        return n_entries, n_bytes
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Any]) -> Any:
+        """
+        Return the cached value, or call fetch and cache its result.
+        Concurrent calls for the same key share a single fetch.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._inflight[key] = Future()
+        if not is_owner:
+            return future.result()
+
+        try:
+            value = fetch()
+        except Exception as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        self.set(key, value)
+        with self._lock:
+            del self._inflight[key]
+        future.set_result(value)
+        return value
+
+    def invalidate(self, key: Optional[str]=None):
+        """Remove the entry of key, or every entry when key is None"""
+        if key is not None:
+            self._path(key).unlink(missing_ok=True)
+            return
+        if not self.dir_cache.exists():
+            return
+        for path in self._iter_entry_paths():
+            path.unlink(missing_ok=True)
@@ -1,24 +1,42 @@
+from typing import TYPE_CHECKING
 from pathlib import Path
 import click
 from click.core import Context
-import importlib.metadata
 
 from .misc import load_config, save_config, LOAD_PATH_CONFIG
-from .database import NotionDatabase
-from .mainfunc import (
-    add_records_from_local_pdfpath,
-    update_unchecked_records_from_doi,
-    update_unchecked_records_from_uploadedpdf,
-    make_bibfile_from_records, make_abbrjson_from_bibpath)
+from . import trace
+
+# Modules for the work of subcommands are imported in each of them,
+# so that papnt starts quickly, e.g. from Quick Action for every PDF.
+if TYPE_CHECKING:
+    from .database import NotionDatabase
+    from .mirror import LocalMirror
+    from .notionprop import CitekeyIndex
 
 
 @click.group(invoke_without_command=True)
+@click.version_option(package_name='papnt')
+@click.option('--profile', 'save_path_profile',
+              type=click.Path(dir_okay=False, path_type=Path),
+              help='Write time spent per stage and requests per service '
+                   'as JSON')
+@click.option('--cprofile', 'save_path_cprofile',
+              type=click.Path(dir_okay=False, path_type=Path),
+              help='Write cProfile stats of converting GROBID output')
 @click.pass_context
-def main(ctx: Context):
+def main(ctx: Context, save_path_profile: Path | None,
+         save_path_cprofile: Path | None):
     ctx.obj = dict(
         config=load_config(),
     )
-    click.echo(f'Welcome to Papnt {importlib.metadata.version("papnt")}')
+    if save_path_profile or save_path_cprofile:
+        trace.TRACER.enable(profile_cpu=save_path_cprofile is not None)
+        ctx.call_on_close(lambda: trace.TRACER.save(
+            save_path_profile, save_path_cprofile,
+            command=ctx.invoked_subcommand))
+    if ctx.invoked_subcommand is None:
+        import importlib.metadata
+        click.echo(f'Welcome to Papnt {importlib.metadata.version("papnt")}')
     click.echo(f'Your config file is in: {LOAD_PATH_CONFIG}')
     if ctx.invoked_subcommand is None:
         click.echo('try `papnt --help` for help')
@@ -26,53 +44,130 @@ def main(ctx: Context):
 @main.command()
 @click.argument(
     'load_paths_pdf', nargs=-1, type=click.Path(exists=True, path_type=Path))
+@click.option('--update-duplicates', is_flag=True,
+              help='Update records of PDFs already recorded, not skip them')
+@click.option('--resume', is_flag=True,
+              help='Continue the interrupted run on the same PDFs')
 @click.pass_context
-def paths(ctx: Context, load_paths_pdf: Path | tuple[Path, ...]):
+def paths(ctx: Context, load_paths_pdf: Path | tuple[Path, ...],
+          update_duplicates: bool, resume: bool):
     """Add record(s) to database by local path to PDF file"""
     if not load_paths_pdf:
         click.echo('Indicate local path(s) of PDF(s)')
         return
+    from .dedup import DedupIndex
+    from .journal import Journal, default_journal_path
+    from .mainfunc import add_records_from_local_pdfpath
 
     db = _fetch_database(ctx)
     propnames = ctx.obj['config']['propnames']
-    add_records_from_local_pdfpath(db, propnames, load_paths_pdf)
+    mirror = _open_mirror(ctx)
+    index = DedupIndex(mirror, propnames['doi'])
+    index.seed(db)
+    database_id = _complete_config(ctx, 'database', 'database_id')
+    load_path_journal = default_journal_path(
+        'paths', database_id, load_paths_pdf)
+    with Journal(load_path_journal, resume) as journal:
+        add_records_from_local_pdfpath(db, propnames, load_paths_pdf,
+                                       index, update_duplicates,
+                                       _load_citekeys(mirror, propnames),
+                                       journal)
+    if journal.is_complete('page_id'):  # Nothing left to resume
+        load_path_journal.unlink(missing_ok=True)
 
 
 @main.command()
+@click.option('--local', is_flag=True,
+              help='Find unchecked records in local mirror (see `sync`)')
 @click.pass_context
-def doi(ctx: Context):
+def doi(ctx: Context, local: bool):
     """Fill information in record(s) by DOI"""
+    from .mainfunc import update_unchecked_records_from_doi
+
+    db, mirror = _fetch_database(ctx), _open_mirror(ctx)
+    if not local:  # Citekeys in use are looked up in the mirror
+        mirror.sync(db)
+    propnames = ctx.obj['config']['propnames']
     update_unchecked_records_from_doi(
-        _fetch_database(ctx), ctx.obj['config']['propnames'])
+        db, propnames, mirror if local else None,
+        _load_citekeys(mirror, propnames))
 
 
 @main.command()
+@click.option('--local', is_flag=True,
+              help='Find unchecked records in local mirror (see `sync`)')
 @click.pass_context
-def pdf(ctx: Context):
+def pdf(ctx: Context, local: bool):
     """Fill information in record(s) by uploaded PDF file"""
+    from .mainfunc import update_unchecked_records_from_uploadedpdf
+
+    db, mirror = _fetch_database(ctx), _open_mirror(ctx)
+    if not local:  # Citekeys in use are looked up in the mirror
+        mirror.sync(db)
+    propnames = ctx.obj['config']['propnames']
     update_unchecked_records_from_uploadedpdf(
-        _fetch_database(ctx), ctx.obj['config']['propnames'])
+        db, propnames, mirror if local else None,
+        _load_citekeys(mirror, propnames))
 
 
 @main.command()
-@click.argument('target')
+@click.argument('targets', nargs=-1)
+@click.option('--all', 'all_targets', is_flag=True,
+              help='Make BIB files of every target in database')
+@click.option('--local', is_flag=True,
+              help='Read records from local mirror, works offline')
 @click.pass_context
-def makebib(ctx: Context, target: str):
-    """Make BIB file including reference information from database"""
+def makebib(ctx: Context, targets: tuple[str, ...], all_targets: bool,
+            local: bool):
+    """Make BIB file(s) including reference information from database"""
+    if not (targets or all_targets):
+        click.echo('Indicate target(s), or use --all')
+        return
+    from .mainfunc import make_bibfiles_from_records
+
     config = ctx.obj['config']
 
     save_dir = _complete_config(ctx, 'misc', 'save_bibfile_to')
-    save_path_bib = Path(save_dir) / f'{target}.bib'
-    make_bibfile_from_records(_fetch_database(ctx), target,
-                              config['propnames'], save_path_bib)
-    make_abbrjson_from_bibpath(save_path_bib, config['abbr'])
+    database = _open_mirror(ctx) if local else _fetch_database(ctx)
+    save_paths_bib = make_bibfiles_from_records(
+        database, None if all_targets else targets,
+        config['propnames'], save_dir, special_abbr=config['abbr'])
+    click.echo(f'Made {len(save_paths_bib)} BIB file(s) in {save_dir}')
+
+
+@main.command()
+@click.option('--full', is_flag=True,
+              help='Pull all records again, dropping ones deleted in Notion')
+@click.pass_context
+def sync(ctx: Context, full: bool):
+    """Update local mirror with records edited since last sync"""
+    n_pulled = _open_mirror(ctx).sync(_fetch_database(ctx), full)
+    click.echo(f'Synced {n_pulled} record(s)')
 
 # -- vvv Helper vvv ---
 
-def _fetch_database(ctx: Context) -> NotionDatabase:
+def _fetch_database(ctx: Context) -> 'NotionDatabase':
+    from .database import NotionDatabase
+
     tokenkey = _complete_config(ctx, 'database', 'tokenkey')
     database_id = _complete_config(ctx, 'database', 'database_id')
-    return NotionDatabase(tokenkey, database_id)
+    database = NotionDatabase(tokenkey, database_id)
+    database.check_propnames(ctx.obj['config']['propnames'])
+    return database
+
+
+def _open_mirror(ctx: Context) -> 'LocalMirror':
+    from .mirror import LocalMirror, default_mirror_path
+
+    database_id = _complete_config(ctx, 'database', 'database_id')
+    return LocalMirror(default_mirror_path(database_id))
+
+
+def _load_citekeys(mirror: 'LocalMirror', propnames: dict
+                   ) -> 'CitekeyIndex':
+    from .notionprop import CitekeyIndex
+
+    return CitekeyIndex.from_mirror(mirror, propnames['id'])
 
 
 def _complete_config(ctx: Context, section: str, key: str) -> str:
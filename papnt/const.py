@@ -30,4 +30,22 @@ CROSSREF_TO_BIB = {
     'book-part': 'inbook',
     'book-chapter': 'inbook',
     'proceedings-article': 'inproceedings',
-}
\ No newline at end of file
+}
+
+PROPTYPES = {
+    # Notion property type expected for each key of [propnames] in config
+    'doi': 'rich_text',
+    'author': 'multi_select',
+    'title': 'rich_text',
+    'edition': 'rich_text',
+    'year': 'number',
+    'journal': 'select',
+    'volume': 'rich_text',
+    'pages': 'rich_text',
+    'publisher': 'select',
+    'id': 'rich_text',
+    'entrytype': 'select',
+    'howpublished': 'rich_text',
+    'output_target': 'multi_select',
+    'pdf': 'files',
+}
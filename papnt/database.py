@@ -1,75 +1,210 @@
-from typing import Literal, Optional, Dict, List
+from typing import Literal, Optional, Dict, List, Iterator
 from pathlib import Path
-
-from notion_client import Client
-
-
-MAX_LEN_CHILDREN = 100
+import json
+
+from .misc import DIR_CACHE
+from . import trace
+from .ratelimit import ThrottledClient
+from .cache import DiskCache
+from .const import PROPTYPES
+
+
+MAX_LEN_CHILDREN = 100  # per children array
+MAX_N_BLOCKS_REQUEST = 1000  # including nested children
+MAX_BYTES_REQUEST = 450_000  # Notion accepts 500 KB; keep a margin
+MAX_LEN_RICH_TEXT = 100  # per rich_text array
+SCHEMA_TTL = 24 * 60 * 60  # sec
+
+
+def _is_plain_paragraph(block: Dict) -> bool:
+    return (block.keys() <= {'object', 'type', 'paragraph'}) and \
+           ('paragraph' in block) and \
+           (block['paragraph'].keys() == {'rich_text'})
+
+
+def _pack_paragraphs(children: List[Dict]) -> List[Dict]:
+    """Merge adjacent paragraph blocks into one, separated by line breaks,
+    as far as the rich_text array of a block can hold."""
+    packed = []
+    for block in children:
+        previous = packed[-1] if packed else None
+        if not (_is_plain_paragraph(block) and previous and
+                _is_plain_paragraph(previous)):
+            packed.append(block)
+            continue
+        rich_text = block['paragraph']['rich_text']
+        rich_text_prev = previous['paragraph']['rich_text']
+        if len(rich_text_prev) + 1 + len(rich_text) > MAX_LEN_RICH_TEXT:
+            packed.append(block)
+            continue
+        packed[-1] = previous | {'paragraph': {'rich_text': (
+            rich_text_prev + [{'text': {'content': '\n'}}] + rich_text)}}
+    return packed
+
+
+def _count_blocks(block: Dict) -> int:
+    content = block.get(block.get('type'), {})
+    if not isinstance(content, dict):
+        return 1
+    return 1 + sum(_count_blocks(child)
+                   for child in content.get('children', []))
+
+
+def _batch_children(children: List[Dict], reserved_bytes: int=0
+                    ) -> Iterator[List[Dict]]:
+    """Split children into as few requests as Notion's limits allow.
+    reserved_bytes is taken from the budget of the first request."""
+    batch, n_blocks, n_bytes = [], 0, reserved_bytes
+    for block in children:
+        n_blocks_ = _count_blocks(block)
+        n_bytes_ = len(json.dumps(block).encode()) + 1
+        if batch and ((len(batch) == MAX_LEN_CHILDREN) or
+                      (n_blocks + n_blocks_ > MAX_N_BLOCKS_REQUEST) or
+                      (n_bytes + n_bytes_ > MAX_BYTES_REQUEST)):
+            yield batch
+            batch, n_blocks, n_bytes = [], 0, 0
+        batch.append(block)
+        n_blocks += n_blocks_
+        n_bytes += n_bytes_
+    if batch:
+        yield batch
 
 
 class NotionDatabase:
-    def __init__(self, tokenkey: str, database_id: str):
-        self.notion = Client(auth=tokenkey)
+    def __init__(self, tokenkey: str, database_id: str,
+                 cache: Optional[DiskCache]=None, **client_options):
+        """client_options: passed to ThrottledClient, e.g. base_url"""
+        self.notion = ThrottledClient(auth=tokenkey, **client_options)
         self.database_id = database_id
-
-    def fetch_records(self, filter: Optional[dict]=None, debugmode: bool=False
-                      ) -> List:
-        records = []
+        self.cache = cache or DiskCache(DIR_CACHE / 'schema', ttl=SCHEMA_TTL)
+        self._schema = None
+
+    @property
+    def schema(self) -> Dict:
+        """{'data_source_id': str, 'properties': {name: type}}"""
+        if self._schema is None:
+            self._schema = self.cache.get(self.database_id)
+        if self._schema is None:
+            self._schema = self._retrieve_schema()
+            self.cache.set(self.database_id, self._schema)
+        return self._schema
+
+    @property
+    def data_source_id(self) -> str:
+        return self.schema['data_source_id']
+
+    def _retrieve_schema(self) -> Dict:
+        data_source_id = (
+            self.notion.databases
+            .retrieve(self.database_id)['data_sources'][0]['id'])
+        data_source = self.notion.data_sources.retrieve(data_source_id)
+        properties = {name: prop['type']
+                      for name, prop in data_source['properties'].items()}
+        return {'data_source_id': data_source_id, 'properties': properties}
+
+    def invalidate_schema(self):
+        self.cache.invalidate(self.database_id)
+        self._schema = None
+
+    def check_propnames(self, propnames: Dict):
+        """Raise ValueError if a property in propnames is missing or has
+        an unexpected type. The cached schema is refreshed once before
+        giving up, in case the database has been edited since."""
+        def find_mismatches() -> List[str]:
+            properties = self.schema['properties']
+            expected = {propname: PROPTYPES.get(key)
+                        for key, propname in propnames.items()}
+            expected['info'] = 'checkbox'
+            mismatches = []
+            for propname, proptype in expected.items():
+                if propname not in properties:
+                    mismatches.append(f'{propname} (missing)')
+                elif proptype and (properties[propname] != proptype):
+                    mismatches.append(
+                        f'{propname} ({properties[propname]}, '
+                        f'expected {proptype})')
+            return mismatches
+
+        if not find_mismatches():
+            return
+        self.invalidate_schema()
+        if mismatches := find_mismatches():
+            raise ValueError('Properties in config do not match database: '
+                             + ', '.join(mismatches))
+
+    def iter_records(self, filter: Optional[dict]=None,
+                     debugmode: bool=False) -> Iterator[Dict]:
+        """Yield records as soon as each page of query results arrives"""
         start_cursor = None
         while True:
-            data_source_id = (
-                self.notion.databases
-                .retrieve(self.database_id)['data_sources'][0]['id'])
-            database = self.notion.data_sources.query(
-                data_source_id=data_source_id,
-                filter=filter,
-                start_cursor=start_cursor)
-            records += database['results']
+            with trace.span('notion.query'):
+                database = self.notion.data_sources.query(
+                    data_source_id=self.data_source_id,
+                    filter=filter,
+                    start_cursor=start_cursor)
+            yield from database['results']
             if not database['has_more']:
-                self.db_results = records
-                return self
+                return
             start_cursor = database['next_cursor']
             if debugmode:
                 print('It is debugmode, records were fetched partly.')
-                self.db_results = records
-                return self
+                return
+
+    def drain_records(self, filter: dict) -> Iterator[Dict]:
+        """
+        Yield records matching filter, for callers updating them so that
+        they no longer match. Cursors are not stable when the matching set
+        changes, so the query is run again from the start until it finds
+        no records not yet yielded.
+        """
+        yielded = set()
+        while True:
+            n_yielded = len(yielded)
+            for record in self.iter_records(filter):
+                if record['id'] not in yielded:
+                    yielded.add(record['id'])
+                    yield record
+            if len(yielded) == n_yielded:
+                return
+
+    def fetch_records(self, filter: Optional[dict]=None, debugmode: bool=False
+                      ) -> List:
+        self.db_results = list(self.iter_records(filter, debugmode))
+        return self
 
-    def update_properties(self, page_id: str, prop: Dict):
+    def update_properties(self, page_id: str, prop: Dict) -> Dict:
         prop['info'] = {'checkbox': True}
-        self.notion.pages.update(page_id=page_id, properties=prop)
+        with trace.span('notion.update'):
+            return self.notion.pages.update(page_id=page_id, properties=prop)
 
     def update_record(self, page_id: str, prop: Dict,
-                      children: Optional[List]=None):
+                      children: Optional[List]=None) -> Dict:
         prop = prop | {'info': {'checkbox': True}}
-        self.update_properties(page_id, prop)
+        page = self.update_properties(page_id, prop)
 
-        if children is None:
-            children = []
-        for i in range(0, len(children), MAX_LEN_CHILDREN):
-            batch = children[i:i + MAX_LEN_CHILDREN]
-            self.notion.blocks.children.append(
-                block_id=page_id, children=batch)
+        for batch in _batch_children(_pack_paragraphs(children or [])):
+            with trace.span('notion.append'):
+                self.notion.blocks.children.append(
+                    block_id=page_id, children=batch)
+        return page
 
     def create(self, prop: Dict, children: Optional[List]=None,
-               check_info: bool=True):
-        if children is None:
-            children = []
-        children_till_100 = children[:MAX_LEN_CHILDREN]
+               check_info: bool=True) -> Dict:
         if check_info:
             prop = prop | {'info': {'checkbox': True}}
-        newpage = self.notion.pages.create(
-            parent={'database_id': self.database_id},
-            properties=prop, children=children_till_100)
-
-        if len(children) <= MAX_LEN_CHILDREN:
-            return
-
-        children_from_100 = children[MAX_LEN_CHILDREN:]
-        for i in range(0, len(children_from_100), MAX_LEN_CHILDREN):
-            batch = children_from_100[i:i + MAX_LEN_CHILDREN]
-            self.notion.blocks.children.append(
-                block_id=newpage['id'],
-                children=batch)
+        batches = _batch_children(_pack_paragraphs(children or []),
+                                  len(json.dumps(prop).encode()))
+        with trace.span('notion.create'):
+            newpage = self.notion.pages.create(
+                parent={'database_id': self.database_id},
+                properties=prop, children=next(batches, []))
+
+        for batch in batches:
+            with trace.span('notion.append'):
+                self.notion.blocks.children.append(
+                    block_id=newpage['id'],
+                    children=batch)
+        return newpage
 
     def add_children(self, page_id: str, contents: str | List | None,
                      blocktype: Literal['paragraph'], title: str='title'):
@@ -0,0 +1,79 @@
+from typing import Dict, Optional
+from pathlib import Path
+from threading import Lock
+import re
+
+from .mirror import LocalMirror
+
+
+def normalize_doi(doi: str) -> str:
+    """DOIs are case-insensitive and often written as URL"""
+    doi = doi.strip().lower().replace('//', '/')
+    return re.sub(r'^(https?:/(dx\.)?doi\.org/|doi:\s?)', '', doi)
+
+
+class DedupIndex:
+    """
+    PDF content hashes and DOIs of pages already in the database.
+    DOIs come from the local mirror; hashes are stored next to it,
+    as only papnt knows which file each page was made from.
+    """
+    def __init__(self, mirror: LocalMirror, propname_doi: str):
+        self.mirror = mirror
+        self.propname_doi = propname_doi
+        self.mirror.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                sha256 TEXT PRIMARY KEY,
+                page_id TEXT NOT NULL)""")
+        self._hashes: Dict[str, str | Path] = {}
+        self._dois: Dict[str, str | Path] = {}
+        self._lock = Lock()
+
+    def seed(self, database):
+        """Pull pages edited since the last sync and index them"""
+        self.mirror.sync(database)
+        for page_id, doi in self.mirror.iter_texts(self.propname_doi):
+            self._dois[normalize_doi(doi)] = page_id
+        # Hashes of pages deleted from the database are left out
+        rows = self.mirror.conn.execute(
+            'SELECT sha256, page_id FROM files '
+            'WHERE page_id IN (SELECT id FROM pages)')
+        self._hashes = dict(rows)
+
+    def claim(self, load_path_pdf: Path, digest: Optional[str]=None,
+              doi: Optional[str]=None) -> str | Path | None:
+        """
+        Return ID of the page already made from the same PDF or DOI, or
+        path of the PDF which claimed it earlier in this run. Otherwise
+        claim the hash and DOI for load_path_pdf and return None.
+        """
+        keys = [(self._hashes, digest),
+                (self._dois, doi and normalize_doi(doi))]
+        with self._lock:
+            for index, key in keys:
+                if key and (index.get(key, load_path_pdf) != load_path_pdf):
+                    return index[key]
+            for index, key in keys:
+                if key:
+                    index[key] = load_path_pdf
+        return None
+
+    def release(self, load_path_pdf: Path):
+        """Drop claims of a PDF which failed to be recorded"""
+        with self._lock:
+            for index in (self._hashes, self._dois):
+                for key in [key for key, value in index.items()
+                            if value == load_path_pdf]:
+                    del index[key]
+
+    def add(self, page_id: str, digest: str, doi: Optional[str]=None):
+        with self._lock:
+            self._hashes[digest] = page_id
+            # Keep the page first known by the DOI
+            if doi and not isinstance(
+                    self._dois.get(normalize_doi(doi)), str):
+                self._dois[normalize_doi(doi)] = page_id
+        with self.mirror.conn:
+            self.mirror.conn.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?)',
+                (digest, page_id))
@@ -0,0 +1,81 @@
+from typing import Dict, Iterable
+from pathlib import Path
+from hashlib import sha1
+from threading import Lock
+from time import time
+import json
+
+from .misc import DIR_CACHE
+
+
+def default_journal_path(command: str, database_id: str,
+                         load_paths: Iterable[str | Path]) -> Path:
+    """One journal per set of inputs, so that runs on other inputs, e.g.
+    overlapping ones of a Quick Action per PDF, keep theirs"""
+    inputs = '\n'.join(sorted(str(Path(p).resolve()) for p in load_paths))
+    digest = sha1(inputs.encode()).hexdigest()[:16]
+    return DIR_CACHE / 'journal' / f'{command}-{database_id}-{digest}.jsonl'
+
+
+class Journal:
+    """
+    Append-only log of stages completed per input file or record id,
+    one JSON line per stage, so that an interrupted run can be resumed.
+    Lines cut off by a crash are ignored when read back. Lines are only
+    appended, also by runs not resuming, as other runs may be using it.
+    """
+    def __init__(self, load_path: str | Path, resume: bool=False):
+        """resume: continue from the stages in the journal, otherwise
+        only those recorded from now on are known"""
+        load_path = Path(load_path)
+        load_path.parent.mkdir(parents=True, exist_ok=True)
+        self.load_path = load_path
+        self._entries: Dict[str, Dict] = {}
+        if resume and load_path.exists():
+            self._replay()
+        self._file = load_path.open('a')
+        if self._file.tell() and not self._ends_with_newline():
+            self._file.write('\n')  # End the line cut off by a crash
+        self._lock = Lock()
+
+    def _replay(self):
+        with self.load_path.open() as f:
+            for line in f:
+                try:
+                    stage = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._entries.setdefault(stage.pop('key'), {}).update(stage)
+
+    def _ends_with_newline(self) -> bool:
+        with self.load_path.open('rb') as f:
+            f.seek(-1, 2)
+            return f.read() == b'\n'
+
+    def get(self, key: str) -> Dict:
+        """Stages completed for key, merged; each with time of the last"""
+        with self._lock:
+            return dict(self._entries.get(key, {}))
+
+    def record(self, key: str, **stages):
+        """e.g. record(path, doi='10.1234/abc'). Written through at once,
+        as the process may die at any later moment."""
+        stages = {'time': time()} | stages
+        with self._lock:
+            self._entries.setdefault(key, {}).update(stages)
+            self._file.write(json.dumps({'key': key} | stages) + '\n')
+            self._file.flush()
+
+    def is_complete(self, stage: str) -> bool:
+        """Whether every key known has reached stage"""
+        with self._lock:
+            return all(stage in stages for stages in self._entries.values())
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,118 +1,427 @@
-from typing import Tuple
+from __future__ import annotations
+from typing import (
+    TYPE_CHECKING, Tuple, Optional, Iterable, Iterator, Dict, List)
 from pathlib import Path
-import requests
+from itertools import islice
+from tempfile import TemporaryDirectory
+from time import time
+from hashlib import sha1
+import json
 
-from bibtexparser.bwriter import BibTexWriter
-from bibtexparser.bibdatabase import BibDatabase
+from .misc import load_config, write_if_changed, FailLogger, DIR_CACHE
+from .cache import DiskCache, file_sha256
+from .pipeline import Stage, StageError, run_pipeline
+from . import trace
 
-from .misc import load_config, FailLogger
-from .database import NotionDatabase
-from .abbrlister import AbbrLister
-from .pdf2doi import pdf_to_doi
-from .notionprop import NotionPropMaker, to_notionprop, add_fileupload_prop
-from .prop2entry import notionprop_to_entry
-from .pdf2text import PDF2ChildrenConverter
+# Heavy modules (GROBID, PDF, Crossref, arXiv, BibTeX) are imported by
+# the functions using them, so that each command loads only its own
+if TYPE_CHECKING:
+    from .database import NotionDatabase
+    from .mirror import LocalMirror
+    from .dedup import DedupIndex
+    from .notionprop import CitekeyIndex
+    from .pdf2text import PDF2ChildrenConverter
+    from .journal import Journal
 
 
 DEBUGMODE = False
+N_RECORDS_PREFETCH = 100  # Records whose arXiv info is looked up together
+DOWNLOAD_CHUNK_SIZE = 1 << 16  # bytes
+DOWNLOAD_TIMEOUT = 60  # sec, to connect and between chunks
+UPLOAD_REUSE_TTL = 50 * 60  # sec; Notion drops uploads not attached in 1h
+BIBTEX_CACHE = DiskCache(DIR_CACHE / 'bibtex', max_entries=50000)
+
+
+def _chunked(iterable: Iterable, n: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, n)):
+        yield chunk
+
+
+def _load_pipeline_config() -> dict:
+    DEFAULT = dict(workers_metadata=4, workers_upload=2, workers_download=4,
+                   queue_size=4)
+    return DEFAULT | load_config().get('pipeline', {})
+
+
+def _make_converter() -> PDF2ChildrenConverter:
+    from .pdf2text import PDF2ChildrenConverter
+    config = load_config()['grobid']
+    return PDF2ChildrenConverter(config['server'], config.get('n_parallel', 4))
+
+
+def _assign_citekeys(citekeys: Optional[CitekeyIndex], props: List[dict],
+                     page_ids: List[Optional[str]], propnames: dict):
+    """Replace citekeys in props by unique ones, in the order of props"""
+    if citekeys is None:
+        return
+    from .notionprop import to_notionprop
+    propname_id = propnames.get('id') or 'id'
+    targets = [(prop, page_id) for prop, page_id in zip(props, page_ids)
+               if propname_id in prop]
+    assigned = citekeys.assign(
+        [prop[propname_id]['rich_text'][0]['text']['content']
+         for prop, _ in targets],
+        [page_id for _, page_id in targets])
+    for (prop, _), citekey in zip(targets, assigned):
+        prop[propname_id] = to_notionprop(citekey, 'rich_text')
 
 
 def add_records_from_local_pdfpath(database: NotionDatabase, propnames: dict,
-                                   load_paths_pdf: Tuple[Path, ...]):
+                                   load_paths_pdf: Tuple[Path, ...],
+                                   index: Optional[DedupIndex]=None,
+                                   update_duplicates: bool=False,
+                                   citekeys: Optional[CitekeyIndex]=None,
+                                   journal: Optional[Journal]=None):
+    """
+    index: PDFs already recorded, by content or DOI, are skipped
+    update_duplicates: update properties of the recorded page instead
+    citekeys: citekeys in use, to keep new ones unique
+    journal: stages completed per PDF are logged, and those logged by
+        an interrupted run are reused if the PDF is unchanged
+    """
+    from .pdf2doi import pdf_to_doi
+    from .notionprop import (
+        NotionPropMaker, to_notionprop, add_fileupload_prop)
 
-    def extract_prop_from_pdf(load_path_pdf: Path, logger: FailLogger) -> dict:
-        logger.set_path(load_path_pdf)
-        emptyprop = {'Name': to_notionprop(load_path_pdf.name, 'title')}
-        doi: str | None = pdf_to_doi(load_path_pdf)
-        if doi is None:
-            logger.log_no_doi_extracted()
-            prop = emptyprop
+    def is_to_be_recorded(record: dict, **keys) -> bool:
+        if (index is None) or ('page_id' in record):
+            return True
+        duplicate = index.claim(record['path'], **keys)
+        if duplicate is None:
+            return True
+        record['duplicate'] = duplicate
+        if isinstance(duplicate, Path) or not update_duplicates:
+            record['skip'] = True
+            return False
+        record['page_id'] = duplicate
+        return True
+
+    def log_stage(record: dict, **stages):
+        if journal is not None:
+            journal.record(str(record['path'].resolve()), **stages)
+
+    def load_stages(record: dict) -> dict:
+        """Stages logged by the interrupted run for the same PDF"""
+        if journal is None:
+            return {}
+        done = journal.get(str(record['path'].resolve()))
+        return done if done.get('sha256') == record['sha256'] else {}
+
+    def extract_prop_from_pdf(record: dict) -> dict:
+        load_path_pdf = record['path']
+        record['prop'] = {'Name': to_notionprop(load_path_pdf.name, 'title')}
+        if (index is not None) or (journal is not None):
+            with trace.span('sha256'):
+                record['sha256'] = file_sha256(load_path_pdf)
+        done = record['done'] = load_stages(record)
+        if 'page_id' in done:
+            record |= {'skip': True, 'duplicate': done['page_id']}
+            return record
+        if (index is not None) and \
+           not is_to_be_recorded(record, digest=record['sha256']):
+            return record
+        if 'doi' in done:
+            record['doi'] = done['doi']
+        else:
+            with trace.span('pdf2doi'):
+                record['doi'] = pdf_to_doi(load_path_pdf)
+            log_stage(record, sha256=record['sha256'], doi=record['doi'])
+        if record['doi'] is None:
+            return record
+        if not is_to_be_recorded(record, doi=record['doi']):
+            return record
+        if 'prop' in done:
+            record['prop'] = done['prop']
+            if done['no_doi_info']:
+                record['no_doi_info'] = True
+            return record
         try:
-            prop = NotionPropMaker().from_doi(doi, propnames)
-        except Exception as e:
-            logger.log_no_doi_info(doi)
-            prop = emptyprop
-        return add_fileupload_prop(
-            prop, load_path_pdf, database.notion, propnames['pdf'])
+            record['prop'] = NotionPropMaker().from_doi(
+                record['doi'], propnames)
+        except Exception:
+            record['no_doi_info'] = True
+        log_stage(record, prop=record['prop'],
+                  no_doi_info=record.get('no_doi_info', False))
+        return record
+
+    def upload_pdf(record: dict) -> dict:
+        if record.get('skip'):
+            return record
+        done = record['done']
+        if done.get('uploaded_at', 0) > time() - UPLOAD_REUSE_TTL:
+            record['prop'][propnames['pdf']] = done['upload']
+            return record
+        record['prop'] = add_fileupload_prop(
+            record['prop'], record['path'], database.notion, propnames['pdf'])
+        log_stage(record, upload=record['prop'][propnames['pdf']],
+                  uploaded_at=time())
+        return record
+
+    def convert_pdf(record: dict) -> dict:
+        # Fulltext is already in the page of duplicates
+        if record.get('skip') or ('page_id' in record):
+            record['children'] = None
+            return record
+        # Blocks converted by the interrupted run come from the cache
+        record['children'] = converter.convert(record['path'])
+        log_stage(record, children=len(record['children'] or []))
+        return record
 
     if len(load_paths_pdf) == 1 and load_paths_pdf[0].is_dir():
         load_paths_pdf = tuple(load_paths_pdf[0].glob('*.pdf'))
 
-    converter = PDF2ChildrenConverter(
-        load_config()['grobid']['server'])
+    config = _load_pipeline_config()
+    converter = _make_converter()
+    stages = [
+        Stage('metadata', extract_prop_from_pdf, config['workers_metadata']),
+        Stage('upload', upload_pdf, config['workers_upload']),
+        Stage('grobid', convert_pdf, converter.n_parallel)]
+    records = [{'path': load_path_pdf} for load_path_pdf in load_paths_pdf]
+
     logger = FailLogger()
-    for load_path_pdf in load_paths_pdf:
-        prop = extract_prop_from_pdf(load_path_pdf, logger)
-        children = converter.convert(load_path_pdf)
-        database.create(prop, children)
-        print(f'Recorded: {load_path_pdf}')
+    for record, result in run_pipeline(records, stages, config['queue_size']):
+        logger.set_path(record['path'])
+        if record.get('doi', '') is None:
+            logger.log_no_doi_extracted()
+        if record.get('no_doi_info'):
+            logger.log_no_doi_info(record['doi'])
+        if isinstance(result, StageError):
+            logger.log_failure(result.stage, result.error)
+            if index is not None:
+                index.release(record['path'])
+            continue
+        if result.get('skip'):
+            print(f'Skipped: {record["path"]} '
+                  f'(same as {result["duplicate"]})')
+            if isinstance(result['duplicate'], str):  # Page in database
+                log_stage(result, page_id=result['duplicate'])
+            continue
+        _assign_citekeys(citekeys, [result['prop']], [result.get('page_id')],
+                         propnames)
+        try:
+            if 'page_id' in result:
+                page = database.update_properties(
+                    result['page_id'], result['prop'])
+            else:
+                page = database.create(result['prop'], result['children'])
+        except Exception as e:
+            logger.log_failure('notion', e)
+            if index is not None:
+                index.release(record['path'])
+            continue
+        print(f'{"Updated" if "page_id" in result else "Recorded"}: '
+              f'{record["path"]}')
+        log_stage(result, page_id=page['id'])
+        if index is not None:
+            index.add(page['id'], result['sha256'], result.get('doi'))
 
     shallowest_pdf = min(load_paths_pdf, key=lambda p: len(p.parts))
     logger.export_to_text(shallowest_pdf.parent)
 
 
-def _update_record_from_doi(
-        database: NotionDatabase, doi: str, id_record: str, propnames: dict):
+def _make_prop_from_doi(doi: str, propnames: dict) -> dict:
+    from .notionprop import NotionPropMaker
     try:
-        prop = NotionPropMaker().from_doi(doi, propnames)
-        database.update_properties(id_record, prop)
+        return NotionPropMaker().from_doi(doi, propnames)
     except Exception as e:
         raise RuntimeError(f'Error while updating record: {doi}') from e
 
 
-def update_unchecked_records_from_doi(database: NotionDatabase, propnames: dict):
+def update_unchecked_records_from_doi(database: NotionDatabase, propnames: dict,
+                                      mirror: Optional[LocalMirror]=None,
+                                      citekeys: Optional[CitekeyIndex]=None):
+    """
+    mirror: read unchecked records from the local mirror instead
+    citekeys: citekeys in use, to keep new ones unique
+    """
+    from .notionprop import NotionPropMaker
     notionfilter = {
         'and': [{'property': 'info', 'checkbox': {'equals': False}},
                 {'property': 'DOI', 'rich_text': {'is_not_empty': True}}]}
-    for record in database.fetch_records(notionfilter).db_results:
-        doi = record['properties']['DOI']['rich_text'][0]['plain_text']
-        _update_record_from_doi(database, doi, record['id'], propnames)
+    records = (mirror or database).drain_records(notionfilter)
+    for records_ in _chunked(records, N_RECORDS_PREFETCH):
+        dois = [record['properties']['DOI']['rich_text'][0]['plain_text']
+                for record in records_]
+        NotionPropMaker().prefetch(dois)
+        records_made, props = [], []
+        for record, doi in zip(records_, dois):
+            try:
+                props.append(_make_prop_from_doi(doi, propnames))
+            except RuntimeError as e:
+                print(f'{e} ({e.__cause__})')
+                continue
+            records_made.append(record)
+        _assign_citekeys(citekeys, props,
+                         [record['id'] for record in records_made], propnames)
+        for record, prop in zip(records_made, props):
+            page = database.update_properties(record['id'], prop)
+            if mirror:
+                mirror.upsert(page)
 
 
 def update_unchecked_records_from_uploadedpdf(
-        database: NotionDatabase, propnames: dict):
+        database: NotionDatabase, propnames: dict,
+        mirror: Optional[LocalMirror]=None,
+        citekeys: Optional[CitekeyIndex]=None):
+    """
+    mirror: read unchecked records from the local mirror instead
+    citekeys: citekeys in use, to keep new ones unique
+    """
+    import requests
+    from .pdf2doi import pdf_to_doi
+    from .notionprop import NotionPropMaker, to_notionprop
 
-    def download_pdf(save_path_temppdf: Path, record: dict):
+    def download_pdf(record: dict) -> Path:
+        if mirror:  # URLs of Notion-hosted files expire in an hour
+            record = database.notion.pages.retrieve(page_id=record['id'])
         files = record['properties'][propnames['pdf']]['files']
-        pdffile = requests.get(files[0]['file']['url']).content
-        with save_path_temppdf.open(mode='wb') as f:
-            f.write(pdffile)
+        save_path_pdf = (Path(dir_temp) / record['id'] /
+                         Path(files[0]['name']).name)
+        save_path_pdf.parent.mkdir()
+        with trace.span('download'), \
+             session.get(files[0]['file']['url'], stream=True,
+                         timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            with save_path_pdf.open(mode='wb') as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        trace.count('download', requests=1,
+                    bytes_received=save_path_pdf.stat().st_size)
+        records[save_path_pdf] = record
+        return save_path_pdf
+
+    def download_all() -> Iterator[Path]:
+        # Downloads run ahead of GROBID and DOI extraction, as far as
+        # the queue of the pipeline allows
+        for record, result in run_pipeline(
+                (mirror or database).drain_records(notionfilter),
+                [Stage('download', download_pdf, n_workers)],
+                config['queue_size']):
+            if isinstance(result, StageError):
+                print(f'Failed to download PDF of {record["id"]}: '
+                      f'{result.error}')
+                continue
+            yield result
 
-    SAVE_PATH_TEMPPDF = Path('you-can-delete-this-file.pdf')
-    converter = PDF2ChildrenConverter(
-        load_config()['grobid']['server'])
+    config = _load_pipeline_config()
+    n_workers = config['workers_download']
+    converter = _make_converter()
     notionfilter = {
         'and': [{'property': 'info', 'checkbox': {'equals': False}},
                 {'property': propnames['pdf'],
                  'files': {'is_not_empty': True}}]}
-    for record in database.fetch_records(notionfilter).db_results:
-        download_pdf(SAVE_PATH_TEMPPDF, record)
-        doi = pdf_to_doi(SAVE_PATH_TEMPPDF)
-        prop = {'Name': to_notionprop(SAVE_PATH_TEMPPDF.name, 'title')}
-        if doi is not None:
-            prop = NotionPropMaker().from_doi(doi, propnames)
-        children = converter.convert(SAVE_PATH_TEMPPDF)
-        database.update_record(record['id'], prop, children)
+    records = {}
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=n_workers)
+    with TemporaryDirectory() as dir_temp, requests.Session() as session:
+        session.mount('https://', adapter)
+        for load_path_pdf, children in converter.convert_many(download_all()):
+            record = records.pop(load_path_pdf)
+            with trace.span('pdf2doi'):
+                doi = pdf_to_doi(load_path_pdf)
+            prop = {'Name': to_notionprop(load_path_pdf.name, 'title')}
+            if doi is not None:
+                prop = NotionPropMaker().from_doi(doi, propnames)
+            _assign_citekeys(citekeys, [prop], [record['id']], propnames)
+            page = database.update_record(record['id'], prop, children)
+            if mirror:
+                mirror.upsert(page)
+            load_path_pdf.unlink()
+
+
+class _BibRenderer:
+    """Render records into BibTeX, cached by page and its properties.
+    Joined entries are the same as BibTexWriter().write() of them all."""
+    def __init__(self, propnames: dict, cache: Optional[DiskCache]=None):
+        from bibtexparser.bwriter import BibTexWriter
+        self.propname_to_bibname = {val: key for key, val in propnames.items()}
+        self.cache = cache or BIBTEX_CACHE
+        self.writer = BibTexWriter()
+        self._propnames_key = json.dumps(propnames, sort_keys=True)
+        self._propname_pdf = propnames['pdf']
+
+    def render(self, record: dict) -> dict:
+        from bibtexparser.bibdatabase import BibDatabase
+        from .prop2entry import notionprop_to_entry
+
+        @trace.traced('bibtex')
+        def render_() -> dict:
+            entry = notionprop_to_entry(
+                record['properties'], self.propname_to_bibname)
+            bib_db = BibDatabase()
+            bib_db.entries = [entry]
+            return {'entry': entry, 'bibtex': self.writer.write(bib_db)}
+
+        # last_edited_time is rounded to minutes, so the properties tell
+        # edits within a minute. URLs of uploaded PDFs change per query.
+        props = {name: prop for name, prop in record['properties'].items()
+                 if name != self._propname_pdf}
+        digest = sha1(json.dumps(props, sort_keys=True).encode()).hexdigest()
+        return self.cache.get_or_fetch(
+            f'{record["id"]}:{record["last_edited_time"]}:{digest}:'
+            f'{self._propnames_key}', render_)
+
+    def join(self, rendered: List[dict]) -> str:
+        from bibtexparser.bibdatabase import BibDatabase
+        order = self.writer.order_entries_by
+        rendered = sorted(rendered, key=lambda rendered_: (
+            BibDatabase.entry_sort_key(rendered_['entry'], order)))
+        return self.writer.entry_separator.join(
+            rendered_['bibtex'] for rendered_ in rendered)
+
+
+def make_bibfiles_from_records(database: NotionDatabase | LocalMirror,
+                               targets: Optional[Iterable[str]],
+                               propnames: dict, dir_save_bib: str | Path,
+                               cache: Optional[DiskCache]=None,
+                               special_abbr: Optional[dict]=None
+                               ) -> Dict[str, Path]:
+    """
+    Make a bib file per target from a single query. Files are rewritten
+    only when their content changes.
+    targets: None for every target found in the database
+    cache: shared BIBTEX_CACHE is used by default
+    special_abbr: JSON of journal abbreviations is also made if given
+    Returns paths of the bib files by target.
+    """
+    propname_target = propnames['output_target']
+    if targets is None:
+        notionfilter = {'property': propname_target,
+                        'multi_select': {'is_not_empty': True}}
+    else:
+        targets = list(dict.fromkeys(targets))
+        notionfilter = {'or': [
+            {'property': propname_target, 'multi_select': {'contains': target}}
+            for target in targets]}
 
-        SAVE_PATH_TEMPPDF.unlink()
+    renderer = _BibRenderer(propnames, cache)
+    rendered = {target: [] for target in targets or []}
+    for record in database.iter_records(notionfilter):
+        rendered_ = renderer.render(record)
+        for option in record['properties'][propname_target]['multi_select']:
+            if (targets is None) or (option['name'] in rendered):
+                rendered.setdefault(option['name'], []).append(rendered_)
 
+    save_paths_bib = {}
+    for target, rendered_ in rendered.items():
+        save_paths_bib[target] = Path(dir_save_bib) / f'{target}.bib'
+        write_if_changed(save_paths_bib[target], renderer.join(rendered_))
+        if special_abbr is not None:
+            make_abbrjson_from_entries(
+                [rendered__['entry'] for rendered__ in rendered_],
+                special_abbr, save_paths_bib[target].with_suffix('.json'))
+    return save_paths_bib
 
-def make_bibfile_from_records(database: NotionDatabase, target: str,
-                              propnames: dict, save_path_bib: str):
-    propname_to_bibname = {val: key for key, val in propnames.items()}
-    notionfilter = {'property': propnames['output_target'],
-                    'multi_select': {'contains': target}}
-    entries = [notionprop_to_entry(record['properties'], propname_to_bibname)
-               for record in database.fetch_records(notionfilter).db_results]
 
-    bib_db = BibDatabase()
-    bib_db.entries = entries
-    writer = BibTexWriter()
-    with open(save_path_bib, 'w', encoding='UTF-8') as f:
-        f.write(writer.write(bib_db))
+def make_abbrjson_from_entries(entries: List[dict], special_abbr: dict,
+                               save_path_json: Path):
+    from .abbrlister import AbbrLister
+    with trace.span('abbr'):
+        AbbrLister(entries).listup(special_abbr).save(save_path_json)
 
 
 def make_abbrjson_from_bibpath(load_path_bib: Path, special_abbr: dict):
+    from .abbrlister import AbbrLister
     lister = AbbrLister(load_path_bib)
     save_path_bib = load_path_bib.with_suffix('.json')
     lister.listup(special_abbr).save(save_path_bib)
@@ -0,0 +1,165 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+from pathlib import Path
+import sqlite3
+import json
+
+from .misc import DIR_CACHE
+
+
+def default_mirror_path(database_id: str) -> Path:
+    return DIR_CACHE / 'mirror' / f'{database_id}.sqlite'
+
+
+def _proppath(propname: str) -> str:
+    if '"' in propname:
+        raise NotImplementedError(
+            f'Property name with double quote is not supported: {propname}')
+    return f'$.properties."{propname}"'
+
+
+def _plain_text_sql(path: str, proptype: str) -> str:
+    return ("(SELECT group_concat(json_extract(value, '$.plain_text'), '')"
+            f" FROM json_each(page, '{path}.{proptype}'))")
+
+
+def _filter_to_sql(filter: Dict) -> Tuple[str, List]:
+    """Translate the subset of Notion filter used by papnt into SQL"""
+    for operator in ('and', 'or'):
+        if operator not in filter:
+            continue
+        clauses, params = [], []
+        for subfilter in filter[operator]:
+            clause, params_ = _filter_to_sql(subfilter)
+            clauses.append(f'({clause})')
+            params += params_
+        return f' {operator.upper()} '.join(clauses) or '1', params
+
+    if filter.get('timestamp') == 'last_edited_time':
+        cond = filter['last_edited_time']
+        for key, op in (('on_or_after', '>='), ('after', '>'),
+                        ('on_or_before', '<='), ('before', '<')):
+            if key in cond:
+                return f'last_edited_time {op} ?', [cond[key]]
+        raise NotImplementedError(f'Unsupported filter: {filter}')
+
+    path = _proppath(filter['property'])
+    proptype, cond = next((key, val) for key, val in filter.items()
+                          if key != 'property')
+    match proptype, *cond.items():
+        case 'checkbox', ('equals', value):
+            return f"json_extract(page, '{path}.checkbox') = ?", [int(value)]
+        case ('rich_text' | 'title' | 'files' | 'multi_select' | 'people',
+              ('is_empty' | 'is_not_empty' as key, _)):
+            op = '=' if key == 'is_empty' else '>'
+            return (f"IFNULL(json_array_length(page, '{path}.{proptype}'), 0)"
+                    f" {op} 0"), []
+        case 'rich_text' | 'title', ('equals' | 'contains' as key, value):
+            text = _plain_text_sql(path, proptype)
+            if key == 'equals':
+                return f'{text} = ?', [value]
+            return f"instr({text}, ?) > 0", [value]
+        case 'multi_select', ('contains' | 'does_not_contain' as key, value):
+            exists = ("EXISTS (SELECT 1 FROM json_each(page, "
+                      f"'{path}.multi_select') WHERE "
+                      "json_extract(value, '$.name') = ?)")
+            if key == 'does_not_contain':
+                exists = 'NOT ' + exists
+            return exists, [value]
+        case 'select', ('equals', value):
+            return f"json_extract(page, '{path}.select.name') = ?", [value]
+        case 'select', ('is_empty' | 'is_not_empty' as key, _):
+            op = 'IS' if key == 'is_empty' else 'IS NOT'
+            return f"json_extract(page, '{path}.select') {op} NULL", []
+        case _:
+            raise NotImplementedError(f'Unsupported filter: {filter}')
+
+
+class LocalMirror:
+    """Local SQLite replica of a Notion database, keyed by page id.
+    Can stand in for NotionDatabase when records are only read."""
+
+    def __init__(self, load_path_db: str | Path):
+        load_path_db = Path(load_path_db)
+        load_path_db.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(load_path_db)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                id TEXT PRIMARY KEY,
+                last_edited_time TEXT NOT NULL,
+                page TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT);
+        """)
+
+    @property
+    def watermark(self) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'watermark'").fetchone()
+        return row[0] if row else None
+
+    def upsert(self, page: Dict):
+        with self.conn:
+            self._upsert(page)
+
+    def _upsert(self, page: Dict):
+        if page.get('in_trash') or page.get('archived'):
+            self.conn.execute('DELETE FROM pages WHERE id = ?', (page['id'],))
+            return
+        self.conn.execute(
+            'INSERT OR REPLACE INTO pages VALUES (?, ?, ?)',
+            (page['id'], page['last_edited_time'], json.dumps(page)))
+
+    def sync(self, database, full: bool=False) -> int:
+        """Pull pages edited since the last sync. Pages deleted in Notion
+        are only dropped by a full sync. Returns number of pulled pages."""
+        filter = None
+        if (not full) and (watermark := self.watermark):
+            # last_edited_time is rounded to minutes, so the minute of the
+            # watermark is pulled again; upserting it twice is harmless.
+            filter = {'timestamp': 'last_edited_time',
+                      'last_edited_time': {'on_or_after': watermark}}
+        n_pulled = 0
+        watermark = None if full else self.watermark
+        with self.conn:
+            if full:
+                self.conn.execute('DELETE FROM pages')
+            for page in database.iter_records(filter):
+                self._upsert(page)
+                watermark = max(watermark or '', page['last_edited_time'])
+                n_pulled += 1
+            if watermark:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                    ('watermark', watermark))
+        return n_pulled
+
+    def iter_records(self, filter: Optional[dict]=None,
+                     debugmode: bool=False) -> Iterator[Dict]:
+        clause, params = _filter_to_sql(filter) if filter else ('1', [])
+        # Read all matching rows first; callers may upsert while iterating,
+        # or iterate in another thread than the connection was made in
+        rows = self.conn.execute(
+            f'SELECT page FROM pages WHERE {clause} ORDER BY rowid',
+            params).fetchall()
+        return (json.loads(page) for page, in rows)
+
+    def drain_records(self, filter: dict) -> Iterator[Dict]:
+        """Same as NotionDatabase.drain_records. Rows are read before the
+        first is yielded, so updates while iterating shift nothing."""
+        return self.iter_records(filter)
+
+    def iter_texts(self, propname: str, proptype: str='rich_text'
+                   ) -> Iterator[Tuple[str, str]]:
+        """(page ID, plain text) of pages where the property is not empty,
+        read in SQLite without decoding whole pages"""
+        text = _plain_text_sql(_proppath(propname), proptype)
+        rows = self.conn.execute(
+            f'SELECT id, text FROM (SELECT id, rowid, {text} AS text '
+            "FROM pages) WHERE text != '' ORDER BY rowid").fetchall()
+        return iter(rows)
+
+    def fetch_records(self, filter: Optional[dict]=None,
+                      debugmode: bool=False):
+        self.db_results = list(self.iter_records(filter, debugmode))
+        return self
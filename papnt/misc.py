@@ -1,10 +1,12 @@
 from pathlib import Path
 import tomllib
+import os
 
 import tomli_w
 
 
 LOAD_PATH_CONFIG = Path.home() / '.config/papnt/config.toml'
+DIR_CACHE = Path.home() / '.cache/papnt'
 
 
 def make_config_file_from_template() -> None:
@@ -29,24 +31,47 @@ def save_config(config_data: dict) -> None:
         tomli_w.dump(config_data, f)
 
 
+def write_if_changed(save_path: str | Path, text: str) -> bool:
+    """
+    Replace the file atomically, only when text differs from its content.
+    Unchanged files keep their mtime, so LaTeX builds are not triggered.
+    """
+    save_path = Path(save_path)
+    try:
+        if save_path.read_text(encoding='UTF-8') == text:
+            return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
+    save_path_temp = save_path.with_name(f'.{save_path.name}.{os.getpid()}')
+    with save_path_temp.open('w', encoding='UTF-8') as f:
+        f.write(text)
+    os.replace(save_path_temp, save_path)
+    return True
+
+
 class FailLogger:
     def __init__(self):
         self.no_doi_extracted = []
         self.no_doi_info = []
+        self.failed = []
 
     def set_path(self, load_path_pdf: str | Path):
         self.load_path_pdf = load_path_pdf
 
     def log_no_doi_extracted(self):
-        print('DOI could not be extracted from PDF: {self.load_path_pdf.name}')
+        print(f'DOI could not be extracted from PDF: {self.load_path_pdf.name}')
         self.no_doi_extracted.append(self.load_path_pdf.name)
 
     def log_no_doi_info(self, doi: str):
         print(f'No information on found DOI: {self.load_path_pdf.name} ({doi})')
         self.no_doi_info.append((self.load_path_pdf.name, doi))
 
+    def log_failure(self, stage: str, error: Exception):
+        print(f'Failed at {stage}: {self.load_path_pdf.name} ({error})')
+        self.failed.append((self.load_path_pdf.name, stage, str(error)))
+
     def export_to_text(self, save_path_log: str | Path):
-        if not (self.no_doi_extracted or self.no_doi_info):
+        if not (self.no_doi_extracted or self.no_doi_info or self.failed):
             return
         with (Path(save_path_log) / 'skipped-files.txt').open('w') as f:
             if self.no_doi_extracted:
@@ -60,3 +85,8 @@ class FailLogger:
                     f.write(f"{filename}: ")
                     if doi:
                         f.write(f"https://doi.org/{doi}\n")
+
+            if self.failed:
+                f.write('\n# Failed to record\n')
+                for filename, stage, error in self.failed:
+                    f.write(f"{filename} ({stage}): {error}\n")
@@ -1,22 +1,121 @@
-from typing import Optional, Any, Literal, List
+from __future__ import annotations
+from typing import TYPE_CHECKING, Optional, Any, Literal, List, Dict, Iterable
 from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from threading import Lock
 import string
+import re
 from unidecode import unidecode
 
-from notion_client import Client
-from crossref.restful import Works
-import arxiv
-
+from .misc import DIR_CACHE
+from .cache import DiskCache
 from .const import SKIPWORDS, CROSSREF_TO_BIB
-
-
+from . import trace
+
+# arxiv and crossref are imported when first asked, as citekeys and
+# to_notionprop are used without them
+if TYPE_CHECKING:
+    from notion_client import Client
+    import arxiv
+    from .mirror import LocalMirror
+
+
+SINGLE_PART_MAX_BYTES = 20 * 1024 * 1024  # Larger files are sent in parts
+PART_BYTES = 10 * 1024 * 1024  # Notion accepts 5-20 MB except the last part
+N_PARALLEL_PARTS = 4
+
+METADATA_CACHE = DiskCache(
+    DIR_CACHE / 'metadata',
+    ttl=30 * 24 * 60 * 60,  # sec
+    max_entries=20000,
+    max_bytes=50 * 1024 * 1024,
+    negative_ttl=24 * 60 * 60,  # DOIs not found are asked again a day later
+    compress=True)
+# Fields of Crossref works read by NotionPropMaker._make_properties; the
+# rest, references above all, is not cached
+CROSSREF_FIELDS = (
+    'author', 'published', 'type', 'title', 'container-title', 'DOI',
+    'edition-number', 'volume', 'issue', 'page', 'publisher', 'subject')
+CROSSREF_AUTHOR_FIELDS = ('given', 'family', 'name')
+
+
+class ArxivBatcher:
+    """
+    Send arXiv lookups as multi-id requests through one shared client.
+    Lookups arriving while a request is running go together in the next.
+    """
+    def __init__(self, max_ids: int=100):
+        self.max_ids = max_ids
+        self._client = None
+        self._lock = Lock()
+        self._pending: Dict[str, Future] = {}
+        self._is_fetching = False
+
+    @property
+    def client(self) -> arxiv.Client:
+        if self._client is None:
+            import arxiv
+            self._client = arxiv.Client(page_size=self.max_ids)
+        return self._client
+
+    def fetch(self, arxiv_ids: Iterable[str]
+              ) -> Dict[str, Optional[arxiv.Result]]:
+        """Return papers by ID, None for IDs arXiv does not know"""
+        with self._lock:
+            futures = {arxiv_id: self._pending.setdefault(arxiv_id, Future())
+                       for arxiv_id in arxiv_ids}
+        self._drain()
+        return {arxiv_id: future.result()
+                for arxiv_id, future in futures.items()}
+
+    def _drain(self):
+        with self._lock:
+            if self._is_fetching:  # The running thread will take ours too
+                return
+            self._is_fetching = True
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._is_fetching = False
+                    return
+                batch = dict(list(self._pending.items())[:self.max_ids])
+                for arxiv_id in batch:
+                    del self._pending[arxiv_id]
+            self._fetch_batch(batch)
+
+    def _fetch_batch(self, batch: Dict[str, Future]):
+        import arxiv
+        trace.count('arxiv', requests=1, ids=len(batch))
+        try:
+            search = arxiv.Search(id_list=list(batch), max_results=len(batch))
+            papers = {}
+            with trace.span('arxiv'):
+                for paper in self.client.results(search):
+                    short_id = paper.get_short_id()
+                    papers[short_id] = paper
+                    papers[re.sub(r'v\d+$', '', short_id)] = paper
+        except Exception as e:
+            if len(batch) == 1:
+                next(iter(batch.values())).set_exception(e)
+                return
+            for arxiv_id, future in batch.items():  # Isolate the bad ID
+                self._fetch_batch({arxiv_id: future})
+            return
+        for arxiv_id, future in batch.items():
+            future.set_result(papers.get(arxiv_id))
+
+
+ARXIV_BATCHER = ArxivBatcher()
+
+
+@trace.traced('upload')
 def add_fileupload_prop(prop: dict, load_path_pdf: str | Path, notion: Client,
-                        propname_pdf: Optional[str]=None) -> dict:
-    def filesize_is_ng(load_path_pdf: str | Path, max_size_mb: float = 20.
-                       ) -> bool:
-        return load_path_pdf.stat().st_size > max_size_mb * 1024 * 1024
-
-    def upload_file(load_path_pdf: str | Path, notion: Client) -> str:
+                        propname_pdf: Optional[str]=None,
+                        n_parallel: int=N_PARALLEL_PARTS) -> dict:
+    """Files larger than SINGLE_PART_MAX_BYTES are sent in parts,
+    n_parallel parts at once. Failed parts are retried by ThrottledClient."""
+    def upload_single_part(load_path_pdf: Path, notion: Client) -> str:
         filename = load_path_pdf.name
         res = notion.file_uploads.create(mode='single_part', filename=filename)
         upload_id = res['id']
@@ -28,10 +127,38 @@ def add_fileupload_prop(prop: dict, load_path_pdf: str | Path, notion: Client,
 
         return upload_id
 
-    if filesize_is_ng(load_path_pdf):
-        raise ValueError(f'File size is too large: {load_path_pdf}')
+    def upload_multi_part(load_path_pdf: Path, notion: Client) -> str:
+        def send_part(part_number: int):
+            # Only parts being sent are in memory
+            with open(load_path_pdf, 'rb') as f:
+                f.seek((part_number - 1) * PART_BYTES)
+                part = BytesIO(f.read(PART_BYTES))
+            notion.file_uploads.send(
+                file_upload_id=upload_id,
+                file=(filename, part, 'application/pdf'),
+                part_number=str(part_number))
+
+        filename = load_path_pdf.name
+        n_parts = -(-load_path_pdf.stat().st_size // PART_BYTES)
+        res = notion.file_uploads.create(
+            mode='multi_part', filename=filename,
+            content_type='application/pdf', number_of_parts=n_parts)
+        upload_id = res['id']
 
-    upload_id = upload_file(load_path_pdf, notion)
+        with ThreadPoolExecutor(n_parallel) as executor:
+            for _ in executor.map(send_part, range(1, n_parts + 1)):
+                pass
+        res = notion.file_uploads.complete(file_upload_id=upload_id)
+        if res['status'] != 'uploaded':
+            raise RuntimeError(f'File upload failed: {load_path_pdf}')
+
+        return upload_id
+
+    load_path_pdf = Path(load_path_pdf)
+    if load_path_pdf.stat().st_size > SINGLE_PART_MAX_BYTES:
+        upload_id = upload_multi_part(load_path_pdf, notion)
+    else:
+        upload_id = upload_single_part(load_path_pdf, notion)
 
     prop[propname_pdf or 'pdf'] = {
         'type': 'files',
@@ -89,10 +216,149 @@ def to_notionprop(content: Optional[Any],
             raise RuntimeError('Invalid mode')
 
 
-class NotionPropMaker:
-    def __init__(self):
-        ...
+def _arxiv_to_info(paper: arxiv.Result, doi: str) -> dict:
+    """Convert arXiv result into the form of Crossref works"""
+    authors = []
+    for author in paper.authors:
+        authors.append({
+            'given': ' '.join(author.name.split(' ')[:-1]),
+            'family': author.name.split(' ')[-1]})
+
+    date = paper.published
+    return {
+        'author': authors,
+        'published': {'date-parts': [[date.year, date.month, date.day]]},
+        'type': 'journal-article',
+        'title': [paper.title],
+        'container-title': ['arXiv'],
+        'DOI': doi}
+
+
+def _trim_crossref_info(info: dict) -> dict:
+    info = {key: info[key] for key in CROSSREF_FIELDS if key in info}
+    if 'author' in info:
+        info['author'] = [
+            {key: author[key] for key in CROSSREF_AUTHOR_FIELDS
+             if key in author} for author in info['author']]
+    return info
+
+
+def _up(str_: str) -> str:
+    if len(str_) < 2:
+        return str_.upper()
+    return str_[0].upper() + str_[1:]
+
+
+# from [extensions.zotero.translators.better-bibtex.skipWords], zotero.
+# Words are skipped as they are, in upper case or capitalized.
+_SKIPWORDS_VARIANTS = frozenset(
+    variant for key in SKIPWORDS for variant in (key, key.upper(), _up(key)))
+_TO_SPACE = str.maketrans('/‐—', '   ')  # hyphen and dash, not minus (-).
+_NO_PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+
+def _make_shorttitle(title: str, n_title: int=3) -> str:
+    title = unidecode(title.translate(_TO_SPACE))
+    for key in ['\'s', '\'t', '\'S', '\'T']:
+        title = title.replace(key, '')
+    words = [_up(word) for word in
+             title.translate(_NO_PUNCTUATION).split(' ')
+             if word and (word not in _SKIPWORDS_VARIANTS)]
+    return ''.join(words[:n_title])
+
+
+def make_citekey(lastname: str, title: str, year: int | str) -> str:
+    lastname = unidecode(lastname.replace('_', '')).lower().replace(' ', '')
+    return ''.join([lastname, _make_shorttitle(title), str(year)])
+
+
+def _suffix(n: int) -> str:
+    """a, b, ..., z, aa, ab, ..."""
+    suffix = ''
+    while True:
+        n, remainder = divmod(n, 26)
+        suffix = string.ascii_lowercase[remainder] + suffix
+        if n == 0:
+            return suffix
+        n -= 1
+
+
+class CitekeyIndex:
+    """
+    Citekeys in use, to be kept unique. A citekey taken by another page
+    gets a suffix: a, b, ..., z, aa, ... in the order of assignment.
+    """
+    def __init__(self, citekeys: Optional[Dict[str, Optional[str]]]=None):
+        """citekeys: page ID by citekey"""
+        self._citekeys = dict(citekeys or {})
+        self._n_suffixed: Dict[str, int] = {}
+        self._lock = Lock()
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict], propname_id: str
+                     ) -> 'CitekeyIndex':
+        citekeys = {}
+        for record in records:
+            rich_text = record['properties'][propname_id]['rich_text']
+            if citekey := ''.join(text['plain_text'] for text in rich_text):
+                citekeys[citekey] = record['id']
+        return cls(citekeys)
+
+    @classmethod
+    def from_mirror(cls, mirror: LocalMirror, propname_id: str
+                    ) -> 'CitekeyIndex':
+        """Same as from_records of every page, without decoding them"""
+        return cls({citekey: page_id for page_id, citekey
+                    in mirror.iter_texts(propname_id)})
+
+    def assign(self, citekeys: Iterable[str],
+               page_ids: Optional[Iterable[Optional[str]]]=None
+               ) -> List[str]:
+        """
+        Make citekeys unique, against the index and each other.
+        page_ids: pages to be given the citekeys; a citekey already held
+                  by the same page is kept. None for new pages.
+        """
+        citekeys = list(citekeys)
+        page_ids = list(page_ids or [None] * len(citekeys))
+        assigned = []
+        with self._lock:
+            for citekey, page_id in zip(citekeys, page_ids):
+                unique = citekey
+                while (unique in self._citekeys) and \
+                      ((page_id is None) or
+                       (self._citekeys[unique] != page_id)):
+                    n_suffixed = self._n_suffixed.get(citekey, 0)
+                    self._n_suffixed[citekey] = n_suffixed + 1
+                    unique = citekey + _suffix(n_suffixed)
+                self._citekeys[unique] = page_id
+                assigned.append(unique)
+        return assigned
 
+
+class NotionPropMaker:
+    def __init__(self, cache: Optional[DiskCache]=None):
+        """cache: shared METADATA_CACHE is used by default"""
+        self.cache = cache or METADATA_CACHE
+
+    def prefetch(self, dois: Iterable[str]):
+        """Look up arXiv DOIs among dois in as few requests as possible,
+        so that following from_doi() calls are served from the cache"""
+        arxiv_dois = {}
+        for doi in dois:
+            if (doi is None) or ('arXiv' not in doi):
+                continue
+            doi = doi.replace('//', '/')
+            arxiv_id = doi.split('arXiv.')[1]
+            if self.cache.get(f'arxiv:{arxiv_id}', False) is False:
+                arxiv_dois[arxiv_id] = doi
+        if not arxiv_dois:
+            return
+        for arxiv_id, paper in ARXIV_BATCHER.fetch(arxiv_dois).items():
+            info = paper and _arxiv_to_info(paper, arxiv_dois[arxiv_id])
+            self.cache.set(f'arxiv:{arxiv_id}', info)
+
+    @trace.traced('metadata')
     def from_doi(self, doi: str, propnames: dict) -> dict:
         if 'arXiv' in doi:
             doi_style_info = self._fetch_info_from_arxiv(doi)
@@ -103,75 +369,36 @@ class NotionPropMaker:
     def _fetch_info_from_arxiv(self, doi: str) -> dict:
         doi = doi.replace('//', '/')
         arxiv_id = doi.split('arXiv.')[1]
-        paper = next(arxiv.Client().results(arxiv.Search(id_list=[arxiv_id])))
-
-        authors = []
-        for author in paper.authors:
-            authors.append({
-                'given': ' '.join(author.name.split(' ')[:-1]),
-                'family': author.name.split(' ')[-1]})
-
-        date = paper.published
-        return {
-            'author': authors,
-            'published': {'date-parts': [[date.year, date.month, date.day]]},
-            'type': 'journal-article',
-            'title': [paper.title],
-            'container-title': ['arXiv'],
-            'DOI': doi}
+        info = self.cache.get_or_fetch(
+            f'arxiv:{arxiv_id}', lambda: self._request_arxiv(arxiv_id, doi))
+        if info is None:
+            raise Exception(f'Extracted arXiv ID ({arxiv_id}) was not found.')
+        return info
+
+    def _request_arxiv(self, arxiv_id: str, doi: str) -> dict | None:
+        paper = ARXIV_BATCHER.fetch([arxiv_id])[arxiv_id]
+        if paper is None:
+            return None
+        return _arxiv_to_info(paper, doi)
 
     def _fetch_info_from_doi(self, doi: str) -> dict:
+        from crossref.restful import Works
+
+        def request_crossref() -> dict | None:
+            trace.count('crossref', requests=1)
+            with trace.span('crossref'):
+                info = Works().doi(doi)
+            return _trim_crossref_info(info) if info else None
+
         doi = doi.replace('//', '/')
-        works = Works()
-        info = works.doi(doi)
+        info = self.cache.get_or_fetch(
+            f'crossref:{doi.lower()}', request_crossref)
         if info is None:
             raise Exception(f'Extracted DOI ({doi}) was not found.')
-        return works.doi(doi)
+        return info
 
     def _make_citekey(self, lastname, title, year):
-        # from [extensions.zotero.translators.better-bibtex.skipWords], zotero.
-        def convert_lastname(lastname):
-            lastname = lastname.replace('_', '')
-            return unidecode(lastname).lower().replace(' ', '')
-
-        def up(str_):
-            if len(str_) < 2:
-                return str_.upper()
-            if str_[0] == ' ':
-                return ' ' + str_[1].upper() + str_[2:]
-            return str_[0].upper() + str_[1:]
-
-        def simplify(title):
-            for key in ['/', '‐', '—']: # hyphen and dash, not minus (-).
-                title = title.replace(key, ' ')
-            title = ' ' + unidecode(title) + ' '
-            for key in ['\'s', '\'t', '\'S', '\'T']:
-                title = title.replace(key, '')
-            title = title.translate(str.maketrans('', '', string.punctuation))
-            for key in SKIPWORDS:
-                key = ' ' + key + ' '
-                title = title.replace(key, ' ')
-                title = title.replace(key.upper(), ' ').replace(up(key), ' ')
-            return title
-
-        def make_shorttitle(title, n_title=3):
-            while True:
-                len_before = len(title.replace(' ', ''))
-                title = simplify(title)
-                if len_before == len(title.replace(' ', '')):
-                    break
-
-            title = [up(t) for t in title.split(' ') if t]
-            if len(title) < n_title:
-                return ''.join(title)
-            return ''.join(title[:n_title])
-
-        citekey = ''.join([
-            convert_lastname(lastname),
-            make_shorttitle(title),
-            str(year)])
-
-        return citekey
+        return make_citekey(lastname, title, year)
 
     def _make_properties(self, info: dict, propnames: dict):
         authors = self._make_author_list(info['author'])
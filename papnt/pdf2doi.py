@@ -1,15 +1,131 @@
-from typing import Optional
+from typing import Optional, Iterator, Tuple
 from pathlib import Path
+from time import perf_counter
+import re
 
+import pymupdf
 from pdf2doi import pdf2doi
 
 
-def pdf_to_doi(load_path_pdf: Path | str) -> Optional[str]:
+N_PAGES_SEARCHED = 2  # DOI of the paper is printed on the first pages
+DOI_PATTERN = re.compile(
+    r'\b(10\.\d{4,9})/([-._;()/:a-z0-9<>]+[a-z0-9])', re.IGNORECASE)
+ARXIV_PATTERN = re.compile(
+    r'\barxiv:\s?(\d{4}\.\d{4,5}|[a-z\-]+(?:\.[a-z]{2})?/\d{7})(v\d+)?',
+    re.IGNORECASE)
+# Files downloaded from arXiv are named by their ID, e.g. 2101.00001v2.pdf
+ARXIV_FILENAME_PATTERN = re.compile(r'^(\d{4}\.\d{4,5})(v\d+)?$')
+# '/' cannot be in filename, so it is often replaced
+DOI_FILENAME_PATTERN = re.compile(
+    r'\b(10\.\d{4,9})[/_]([-._;()/:a-z0-9<>]+[a-z0-9])', re.IGNORECASE)
+
+
+def _is_valid_arxiv_id(arxiv_id: str) -> bool:
+    """New style IDs start with YYMM; 5-digit numbers started in 2015"""
+    if '/' in arxiv_id:  # Old style, e.g. hep-th/9901001
+        return True
+    yymm, number = arxiv_id.split('.')
+    yy, mm = int(yymm[:2]), int(yymm[2:])
+    if not ((1 <= mm <= 12) and (yy >= 7)):
+        return False
+    return (len(number) == 5) == (yy >= 15)
+
+
+def _is_valid_doi(doi: str) -> bool:
+    """DOIs have no checksum; reject what only looks like one"""
+    prefix, suffix = doi.split('/', 1)
+    return (len(suffix) <= 200) and (not suffix.lower().startswith('http')) \
+        and (prefix != '10.48550' or 'arxiv.' in suffix.lower())
+
+
+def _arxiv_to_doi(arxiv_id: str) -> str:
+    return f'10.48550/arXiv.{arxiv_id}'
+
+
+def _search_text(text: str) -> Optional[str]:
+    for match in DOI_PATTERN.finditer(text):
+        doi = '/'.join(match.groups())
+        if _is_valid_doi(doi):
+            return doi
+    for match in ARXIV_PATTERN.finditer(text):
+        if _is_valid_arxiv_id(match[1]):
+            return _arxiv_to_doi(match[1])
+    return None
+
+
+def _search_filename(load_path_pdf: Path) -> Optional[str]:
+    stem = load_path_pdf.stem
+    if (match := ARXIV_FILENAME_PATTERN.match(stem)) and \
+       _is_valid_arxiv_id(match[1]):
+        return _arxiv_to_doi(match[1])
+    for match in DOI_FILENAME_PATTERN.finditer(stem):
+        doi = '/'.join(match.groups())
+        if _is_valid_doi(doi):
+            return doi
+    return None
+
+
+def _iter_local_sources(load_path_pdf: Path) -> Iterator[Tuple[str, str]]:
+    """Yield (method, text) from the cheapest source to the dearest"""
+    try:
+        document = pymupdf.open(load_path_pdf)
+    except (pymupdf.FileDataError, RuntimeError):
+        return
+    with document:
+        metadata = ' '.join(str(value) for value in document.metadata.values())
+        _, xref_info = document.xref_get_key(-1, 'Info')
+        if xref_info.endswith(' 0 R'):  # Custom keys such as /doi
+            metadata += ' ' + document.xref_object(int(xref_info.split()[0]))
+        yield 'metadata', metadata
+        yield 'xmp', document.get_xml_metadata()
+        for page in document.pages(0, min(N_PAGES_SEARCHED, len(document))):
+            yield f'text_p{page.number + 1}', page.get_text()
+
+
+def extract_doi(load_path_pdf: Path | str, fallback: bool=True) -> dict:
+    """
+    Look for DOI in metadata, text of the first pages and the filename,
+    and then ask the pdf2doi package (which may search online).
+    arXiv IDs are returned as arXiv DOI (10.48550/arXiv.ID).
+    Returns {'identifier': str or None, 'method': str or None,
+             'elapsed': sec}
+    """
+    start = perf_counter()
+    load_path_pdf = Path(load_path_pdf)
+
+    def result(identifier: Optional[str], method: Optional[str]) -> dict:
+        if identifier is None:
+            method = None
+        return {'identifier': identifier, 'method': method,
+                'elapsed': perf_counter() - start}
+
+    for method, text in _iter_local_sources(load_path_pdf):
+        if doi := _search_text(text):
+            return result(doi, method)
+    if doi := _search_filename(load_path_pdf):
+        return result(doi, 'filename')
+    if not fallback:
+        return result(None, None)
     try:
-        return pdf2doi(str(load_path_pdf))['identifier']
-    except TypeError:
-        return None
+        return result(pdf2doi(str(load_path_pdf))['identifier'], 'pdf2doi')
+    except Exception:  # pdf2doi fails in many ways on broken files
+        return result(None, None)
+
+
+def pdf_to_doi(load_path_pdf: Path | str) -> Optional[str]:
+    return extract_doi(load_path_pdf)['identifier']
 
 
 if __name__ == '__main__':
-    print(pdf_to_doi('samplepdfs/sample3.pdf'))
+    # Hit rate and latency of each method over a folder
+    import sys
+    from collections import Counter
+    load_paths_pdf = sorted(Path(sys.argv[1]).glob('*.pdf'))
+    methods = Counter()
+    for load_path_pdf in load_paths_pdf:
+        info = extract_doi(load_path_pdf)
+        methods[info['method']] += 1
+        print(f"{info['elapsed']:7.3f}s {str(info['method']):9s} "
+              f"{info['identifier']} {load_path_pdf.name}")
+    for method, count in methods.most_common():
+        print(f'{method}: {count}/{len(load_paths_pdf)}')
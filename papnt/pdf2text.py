@@ -1,62 +1,63 @@
-from typing import List
-from copy import deepcopy
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator
+from collections import defaultdict
+from concurrent.futures import (
+    ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED)
+from io import BytesIO
+import json
 import re
-from time import sleep
 from pathlib import Path
 
-from bs4 import BeautifulSoup
-from bs4.element import Tag
-
-from .misc import load_config
+from lxml import etree
 from grobid_client.grobid_client import GrobidClient
 
+from .misc import DIR_CACHE
+from .cache import DiskCache, file_sha256
+from . import trace
 
-TEIURL = r'http://www.tei-c.org/ns/1.0'
 
-class FigTabInfo:
-    def __init__(self, arr: List):
-        """tag, head, desc"""
-        self.arr = arr
-
-    def add_ids_insert(self, ids_insert: List[int]):
-        self.arr = [[idx_insert] + col
-                    for idx_insert, col in zip(ids_insert, self.arr)]
-        return self
-
-    def get_tags(self):
-        if len(self.arr) == 0:
-            return None
-        for tag in list(zip(*self.arr[0])):
-            yield tag
-
-    def descend_by_indices(self):
-        return sorted(self.arr, key=lambda x: x[0], reverse=True)
-
-
-def _change_tag(soup, tag, new_tag_name: str):
-    # https://www.lifewithpython.com/2020/07/python-processing-html-bs4.html
-    new_tag = soup.new_tag(new_tag_name)
-    new_tag.attrs = tag.attrs.copy()
-    tag.wrap(new_tag)
-    tag.unwrap()
-    return new_tag
-
-
-def _extr_xmltext(client: GrobidClient, load_path: str) -> str:
-    # url = 'https://kermitt2-grobid.hf.space'  # DEMO URL provided by GROBID
-    CFG = dict(
-        generateIDs=False,
-        consolidate_header=False,
-        consolidate_citations=False,
-        include_raw_citations=False,
-        include_raw_affiliations=False,
-        tei_coordinates=False,
-        segment_sentences=False)
-    _, _, text = client.process_pdf(
-        'processFulltextDocument', str(load_path), **CFG)
-    if text.startswith('[GENERAL] Could not create temprorary file'):
-        raise RuntimeError('Check permission: ' + text)
-    return text
+TEIURL = r'http://www.tei-c.org/ns/1.0'
+XMLID = '{http://www.w3.org/XML/1998/namespace}id'
+GROBID_CFG = dict(
+    generateIDs=False,
+    consolidate_header=False,
+    consolidate_citations=False,
+    include_raw_citations=False,
+    include_raw_affiliations=False,
+    tei_coordinates=False,
+    segment_sentences=False)
+CONVERTER_VERSION = 1  # Bump when tei2children changes its output
+GROBID_CACHE = DiskCache(
+    DIR_CACHE / 'grobid',
+    max_bytes=500 * 1024 * 1024,
+    compress=True)
+
+
+def _tei_cache_key(digest: str) -> str:
+    """digest: sha256 of PDF"""
+    return f'tei:{digest}:{json.dumps(GROBID_CFG, sort_keys=True)}'
+
+
+def _extr_xmltext(client: GrobidClient, load_path: str,
+                  cache: Optional[DiskCache]=None,
+                  digest: Optional[str]=None) -> str:
+    """TEI of the same PDF is served from the cache, without GROBID"""
+    def process_pdf() -> str:
+        # url = 'https://kermitt2-grobid.hf.space'  # DEMO URL by GROBID
+        with trace.span('grobid'):
+            _, status, text = client.process_pdf(
+                'processFulltextDocument', str(load_path), **GROBID_CFG)
+        trace.count('grobid', requests=1, errors=int(status != 200),
+                    bytes_sent=Path(load_path).stat().st_size,
+                    bytes_received=len(text.encode()))
+        if text.startswith('[GENERAL] Could not create temprorary file'):
+            raise RuntimeError('Check permission: ' + text)
+        if status != 200:  # Not to be cached
+            raise RuntimeError(f'GROBID failed ({status}): {text}')
+        return text
+
+    cache = cache or GROBID_CACHE
+    digest = digest or file_sha256(load_path)
+    return cache.get_or_fetch(_tei_cache_key(digest), process_pdf)
 
 
 def _make_simple_rich_text(text: List[str] | str) -> dict:
@@ -80,224 +81,259 @@ def _make_heading_block(text: str, level: int) -> dict:
             'rich_text': [{'type': 'text', 'text': {'content': text}}]}}
 
 
-def _extr_bib(soup: BeautifulSoup) -> dict:
-    def extr_doi(bib: Tag) -> str:
-        doi = bib.find('idno', {'type': 'DOI'})
-        if doi is None:
-            return ''
-        return f'https://doi.org/{doi.get_text()}'
-
-    bibs = soup.find_all('biblStruct', {'xml:id': True})
-    return {bib['xml:id']: extr_doi(bib) for bib in bibs}
-
-
-def _extr_elements(soup: Tag):
-    bodyset = soup.find_all('div', {'xmlns': TEIURL})
-    elements = []
-    for bodies in bodyset:
-        for body in bodies.find_all(['head', 'p']):
-            elements.append(body)
-    return elements
-
-def _extr_figtab_info(figtabs: Tag) -> FigTabInfo:
-    fig_info = []
-    for figtab in figtabs:
-        tag = figtab.get('xml:id', 'no_tag')
-        head_elem = figtab.find('head')
-        head = head_elem.get_text() if head_elem else ''
-        desc_elem = figtab.find('figDesc')
-        desc = desc_elem.get_text() if desc_elem else ''
-        if desc.startswith(head):
-            desc = desc[len(head):]
-        fig_info.append([tag, head, desc])
-    return FigTabInfo(fig_info)
-
-
-def _extr_fig_info(soup: BeautifulSoup) -> FigTabInfo:
-    figures = soup.find_all('figure', {'type': False})
-    return _extr_figtab_info(figures)
-
-
-def _extr_tab_info(soup: BeautifulSoup) -> FigTabInfo:
-    tables = soup.find_all('figure', {'type': 'table'})
-    return _extr_figtab_info(tables)
-
-
-def _extr_table(soup: BeautifulSoup) -> dict:
-    def tabletag2block(tabletag: Tag) -> str:
-        def tabletag2strlist(table: Tag):
-            rows = table.find_all('row')
-            strlist = []
-            for row in rows:
-                strlist.append(
-                    [cell.get_text() for cell in row.find_all('cell')])
-            return strlist
-
-        def table2block(table: List[List[str]]) -> dict:
-            def row2child(row) -> List[dict]:
-                cells = [_make_simple_rich_text(cell) for cell in row]
-                return {'type': 'table_row',
-                        'table_row': {'cells': cells}}
-            if len(table) == 0:
-                return {'type': 'table',
-                        'table': {'table_width': 0,
-                                  'children': []}}
-            for i, series in enumerate(table):
-                for ii, cell in enumerate(series):
-                    if cell is None:
-                        table[i][ii] = ''
-            children = [row2child(list(row)) for row in zip(*table)]
-            return {'type': 'table',
-                    'table': {'table_width': len(list(zip(*table))[0]),
-                              'children': children}}
-
-        tabletag = tabletag2strlist(tabletag)
-        return table2block(tabletag)
-
-    tables = soup.find_all('figure', {'type': 'table'})
-    blocks = dict()
-    for table in tables:
-        table_id = table['xml:id']
-        table = table.find('table')
-        blocks[table_id] = tabletag2block(table)
-    return blocks
-
-
-def _find_ids_insert(elements: List[BeautifulSoup], info: FigTabInfo
-                     ) -> List[int]:
-    ids_insert = []
-    for tag in info.get_tags():
-        for idx_insert, element in enumerate(elements):
-            if element.find('ref', {'target': f'#{tag}'}):
-                break
-        ids_insert.append(idx_insert + 1)
-    return ids_insert
-
-
-def _insert_figtab(elements: List[BeautifulSoup], info: FigTabInfo
-                   ) -> List[dict]:
-    info = deepcopy(info)
-    info.add_ids_insert(_find_ids_insert(elements, info)).descend_by_indices()
-    for idx_insert, _, head, desc in info.arr:
-        to_insert = BeautifulSoup(f'<p>{head} {desc}</p>', 'xml').find('p')
-        elements.insert(idx_insert, to_insert)
-
-
-def _insert_fig(elements: List[BeautifulSoup], fig_info: FigTabInfo
-                ) -> List[dict]:
-    return _insert_figtab(elements, fig_info)
-
-
-def _insert_tab(elements: List[BeautifulSoup], info: FigTabInfo,
-                tables: dict) -> List[dict]:
-    _insert_figtab(elements, info)
-    info = deepcopy(info)
-    info.add_ids_insert(_find_ids_insert(elements, info)).descend_by_indices()
-    for idx_insert, tag, _, _ in info.arr:
-        elements.insert(idx_insert, tables[tag])
-
-
-def _elements2children_biblink(elements: List, biblinks) -> List:
-    def replace_biblink(element: Tag) -> BeautifulSoup:
-        text = str(element)
-        for key, link in biblinks.items():
-            text = text.replace(f'<ref target="#{key}" type="bibr">',
-                                f'<ref target="{link}" type="bibr">')
-        element = BeautifulSoup(text, 'xml').find(element.name)
-        for empty_link_tag in element.find_all('ref', {'target': ''}):
-            empty_link_tag.unwrap()
-        return element
-
-    def split_texts_by_biblink(element: Tag) -> List[str] | None:
-        if len(bibrefs := element.find_all('ref', {'type': 'bibr'})) == 0:
-            return
-        for bibref in bibrefs:
-            _change_tag(element.parent, bibref, 'bibref')
-        texts = re.split(r'<bibref |</bibref>', str(element))
-        texts = [re.sub(r'<p>|</p>', '', text) for text in texts]
-        return texts
-
-    replaced = []
-    for element in elements:
-        if isinstance(element, dict):
-            replaced.append(element)
+class TEIElement:
+    def __init__(self, name: str, parts: List[Tuple[str, Optional[str]]]):
+        """
+        head or p element of TEI, reduced to what Notion blocks need.
+        parts: texts in order, paired with the target of bibliographic
+               reference (None for ordinary text)
+        """
+        self.name = name
+        self.parts = parts
+
+    def get_text(self) -> str:
+        return ''.join(text for text, _ in self.parts)
+
+
+def _localname(element: etree._Element) -> str | None:
+    if not isinstance(element.tag, str):  # comment or processing instruction
+        return None
+    return etree.QName(element).localname
+
+
+def _find(element: etree._Element, name: str) -> etree._Element | None:
+    return next(element.iter(f'{{*}}{name}'), None)
+
+
+def _get_text(element: etree._Element | None) -> str:
+    return '' if element is None else ''.join(element.itertext())
+
+
+def _free(element: etree._Element):
+    """Drop subtree already converted, keeping memory flat"""
+    element.clear(keep_tail=True)
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+def _extr_element(element: etree._Element) -> TEIElement:
+    def walk(node: etree._Element):
+        if node.text:
+            parts.append((node.text, None))
+        for child in node:
+            if _localname(child) is None:
+                pass
+            elif (_localname(child) == 'ref') and \
+                 (child.get('type') == 'bibr'):
+                parts.append((_get_text(child), child.get('target', '')))
+            else:
+                walk(child)
+            if child.tail:
+                parts.append((child.tail, None))
+
+    parts = []
+    walk(element)
+    return TEIElement(_localname(element), parts)
+
+
+def _extr_doilink(bib: etree._Element) -> str:
+    doi = next((idno for idno in bib.iter('{*}idno')
+                if idno.get('type') == 'DOI'), None)
+    if doi is None:
+        return ''
+    return f'https://doi.org/{_get_text(doi)}'
+
+
+def _extr_figtab(figtab: etree._Element) -> Tuple[str, TEIElement]:
+    tag = figtab.get(XMLID, 'no_tag')
+    head = _get_text(_find(figtab, 'head'))
+    desc = _get_text(_find(figtab, 'figDesc'))
+    if desc.startswith(head):
+        desc = desc[len(head):]
+    return tag, TEIElement('p', [(f'{head} {desc}', None)])
+
+
+def _table2block(table: etree._Element | None) -> dict:
+    rows = [] if table is None else [
+        [_get_text(cell) for cell in row.iter('{*}cell')]
+        for row in table.iter('{*}row')]
+    if len(rows) == 0:
+        return {'type': 'table',
+                'table': {'table_width': 0,
+                          'children': []}}
+    # One table_row per column, as the former converter did
+    columns = list(zip(*rows))
+    children = [{'type': 'table_row',
+                 'table_row': {'cells': [_make_simple_rich_text(cell)
+                                         for cell in column]}}
+                for column in columns]
+    return {'type': 'table',
+            'table': {'table_width': len(columns[0]),
+                      'children': children}}
+
+
+def _parse_tei(xmltext: str) -> Tuple[List[TEIElement], Dict[str, str],
+                                      List[Tuple], Dict[str, int]]:
+    """
+    Walk TEI once. Collect head and p elements inside the divs declaring
+    TEI namespace (those of abstract, body and back), links of references,
+    figures and tables as (tag, caption, table block or None), and the
+    index of the first element referring to each target.
+    """
+    elements, biblinks, figs, tabs, first_refs = [], {}, [], [], {}
+    declares_tei = False
+    is_divs_tei = []  # for each open div
+    ids_open = []  # index in elements for each open head/p
+
+    events = etree.iterparse(
+        BytesIO(xmltext.encode('UTF-8')), events=('start-ns', 'start', 'end'),
+        recover=True, huge_tree=True)
+    for event, node in events:
+        if event == 'start-ns':
+            declares_tei = declares_tei or (node == ('', TEIURL))
             continue
-        element = replace_biblink(element)
-        texts = split_texts_by_biblink(element)
-        if texts is None:
-            replaced.append(element)
+        name = _localname(node)
+        if event == 'start':
+            if name == 'div':
+                is_divs_tei.append(declares_tei)
+            elif (name in ('head', 'p')) and any(is_divs_tei):
+                ids_open.append(len(elements))
+                elements.append(None)
+            declares_tei = False
             continue
-        pattern = r'target="(.*?)" type="bibr">'
+
+        match name:
+            case 'head' | 'p' if any(is_divs_tei):
+                idx = ids_open.pop()
+                elements[idx] = _extr_element(node)
+                for ref in node.iter('{*}ref'):
+                    target = ref.get('target')
+                    first_refs[target] = min(first_refs.get(target, idx), idx)
+            case 'div':
+                if is_divs_tei.pop() and not ids_open:
+                    _free(node)
+            case 'biblStruct':
+                if (key := node.get(XMLID)) is not None:
+                    biblinks[key] = _extr_doilink(node)
+                if not ids_open:
+                    _free(node)
+            case 'figure':
+                tag, caption = _extr_figtab(node)
+                if node.get('type') is None:
+                    figs.append((tag, caption, None))
+                elif node.get('type') == 'table':
+                    tabs.append((tag, caption,
+                                 _table2block(_find(node, 'table'))))
+                if not ids_open:
+                    _free(node)
+    return elements, biblinks, figs + tabs, first_refs
+
+
+def _plan_figtabs(n_elements: int, figtabs: List[Tuple],
+                  first_refs: Dict[str, int]
+                  ) -> Dict[int, List[TEIElement | dict]]:
+    """
+    Place each caption (followed by its table) after the first element
+    referring to it, or at the end when nothing refers to it.
+    Returns the items to insert after each element index.
+    """
+    plan = defaultdict(list)
+    for tag, caption, table in figtabs:
+        idx = first_refs.get(f'#{tag}', n_elements - 1)
+        plan[idx].append(caption)
+        if table is not None:
+            plan[idx].append(table)
+    return plan
+
+
+def _split_text(text: str) -> List[str]:
+    MAX_LENGTH_PARAGPRAH = 2000
+    if len(text) <= MAX_LENGTH_PARAGPRAH:
+        return [text]
+    n_splits = (len(text) // MAX_LENGTH_PARAGPRAH) + 1
+    ids_space = [m.start() for m in re.finditer(r' ', text)]
+    ids_split = [ids_space[i * len(ids_space) // n_splits]
+                 for i in range(1, n_splits)]
+    split_texts = []
+    idx_from = 0
+    for idx_to in ids_split:
+        split_texts.append(text[idx_from:idx_to] + '......')
+        idx_from = idx_to + 1
+    split_texts.append(text[idx_from:])
+    return split_texts
+
+
+def _element2blocks(element: TEIElement, biblinks: Dict[str, str]
+                    ) -> List[dict]:
+    # Texts alternate with links: text, link, text, ..., link, text
+    segments = ['']
+    for text, target in element.parts:
+        if (target is not None) and target.startswith('#') and \
+           (target[1:] in biblinks):
+            target = biblinks[target[1:]]
+        if not target:  # Reference without DOI stays as ordinary text
+            segments[-1] += text
+            continue
+        segments += [(text, target), '']
+
+    if len(segments) > 1:
         rich_text = []
-        for text in texts:
-            if (match := re.search(pattern, text)) is None:
-                rich_text.append({'text': {'content': text}})
+        for segment in segments:
+            if isinstance(segment, str):
+                rich_text.append({'text': {'content': segment}})
                 continue
-            rich_text.append({'text': {'content': re.sub(pattern, '', text),
-                                       'link': {'url': match.group(1)}}})
-        replaced.append(_make_paragraph_block(rich_text))
-    return replaced
+            text, link = segment
+            rich_text.append({'text': {'content': text,
+                                       'link': {'url': link}}})
+        return [_make_paragraph_block(rich_text)]
 
+    if element.name == 'head':
+        return [_make_heading_block(element.get_text(), 1)]
+    return [_make_paragraph_block(_make_simple_rich_text(text))
+            for text in _split_text(element.get_text())]
 
-def _elements2children_heading(elements) -> List:
-    children = []
-    for element in elements:
-        if isinstance(element, dict) or (element.name != 'head'):
-            children.append(element)
-            continue
-        children.append(_make_heading_block(element.get_text(), 1))
-    return children
 
+def tei2children(xmltext: str) -> List[dict]:
+    elements, biblinks, figtabs, first_refs = _parse_tei(xmltext)
+    plan = _plan_figtabs(len(elements), figtabs, first_refs)
 
-def _elements2children_paragraph(elements: List) -> List[dict]:
-    def split_text(text: str) -> List[str]:
-        MAX_LENGTH_PARAGPRAH = 2000
-        if len(text) <= MAX_LENGTH_PARAGPRAH:
-            return [text]
-        n_splits = (len(text) // MAX_LENGTH_PARAGPRAH) + 1
-        ids_space = [m.start() for m in re.finditer(r' ', text)]
-        ids_split = [ids_space[i * len(ids_space) // n_splits]
-                     for i in range(1, n_splits)]
-        split_texts = []
-        idx_from = 0
-        for idx_to in ids_split:
-            split_texts.append(text[idx_from:idx_to] + '......')
-            idx_from = idx_to + 1
-        split_texts.append(text[idx_from:])
-        return split_texts
+    merged = list(plan.get(-1, []))  # Document without text
+    for idx, element in enumerate(elements):
+        merged.append(element)
+        merged += plan.get(idx, [])
 
     children = []
-    for element in elements:
+    for element in merged:
         if isinstance(element, dict):
             children.append(element)
             continue
-        texts = split_text(element.get_text())
-        for text in texts:
-            rich_text = _make_simple_rich_text(text)
-            children.append(_make_paragraph_block(rich_text))
+        children += _element2blocks(element, biblinks)
     return children
 
 
-def pdf2children(client: GrobidClient, load_path: str | Path) -> str | None:
-    soup = BeautifulSoup(_extr_xmltext(client, load_path), 'xml')
-
-    biblinks = _extr_bib(soup)
-    fig_info = _extr_fig_info(soup)
-    tab_info = _extr_tab_info(soup)
-    tables = _extr_table(soup)
+def pdf2children(client: GrobidClient, load_path: str | Path,
+                 cache: Optional[DiskCache]=None) -> List[dict]:
+    """Blocks are cached per PDF content and version of the converter"""
+    def convert() -> List[dict]:
+        xmltext = _extr_xmltext(client, load_path, cache, digest)
+        with trace.span('tei2children'):
+            return trace.profiled(tei2children, xmltext)
 
-    elements = _extr_elements(soup)
-
-    _insert_fig(elements, fig_info)
-    _insert_tab(elements, tab_info, tables)
-    elements = _elements2children_biblink(elements, biblinks)
-    elements = _elements2children_heading(elements)
-    children = _elements2children_paragraph(elements)
-    return children
+    cache = cache or GROBID_CACHE
+    digest = file_sha256(load_path)
+    return cache.get_or_fetch(
+        f'blocks:v{CONVERTER_VERSION}:{_tei_cache_key(digest)}', convert)
 
 
 class PDF2ChildrenConverter:
-    def __init__(self, url: str):
+    def __init__(self, url: str, n_parallel: int=4,
+                 cache: Optional[DiskCache]=None):
+        """
+        n_parallel: number of requests sent to GROBID at once
+        cache: shared GROBID_CACHE is used by default
+        """
+        self.n_parallel = n_parallel
+        self.cache = cache or GROBID_CACHE
         if url == '':
             self.client = None
             return
@@ -310,4 +346,30 @@ class PDF2ChildrenConverter:
 
     def convert(self, load_path_pdf: str | Path):
         if self.client:
-            return pdf2children(self.client, load_path_pdf)
+            return pdf2children(self.client, load_path_pdf, self.cache)
+
+    def convert_many(self, load_paths_pdf: Iterable[str | Path]
+                     ) -> Iterator[Tuple[str | Path, List[dict] | None]]:
+        """
+        Convert PDFs with n_parallel requests running on GROBID, yielding
+        (path, children) as each finishes. load_paths_pdf is consumed
+        lazily, so it may be a generator still producing files.
+        """
+        def convert(load_path_pdf: str | Path):
+            return load_path_pdf, self.convert(load_path_pdf)
+
+        if not self.client:
+            for load_path_pdf in load_paths_pdf:
+                yield load_path_pdf, None
+            return
+
+        with ThreadPoolExecutor(self.n_parallel) as executor:
+            running = set()
+            for load_path_pdf in load_paths_pdf:
+                if len(running) >= self.n_parallel:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                running.add(executor.submit(convert, load_path_pdf))
+            for future in as_completed(running):
+                yield future.result()
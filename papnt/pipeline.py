@@ -0,0 +1,110 @@
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+from queue import Queue
+from threading import Thread, Lock, BoundedSemaphore
+
+
+_SENTINEL = object()
+
+
+class Stage:
+    def __init__(self, name: str, func: Callable[[Any], Any],
+                 n_workers: int=1):
+        """func receives the output of the previous stage"""
+        if n_workers < 1:
+            raise ValueError(f'Stage {name} needs at least one worker.')
+        self.name = name
+        self.func = func
+        self.n_workers = n_workers
+
+
+class StageError:
+    def __init__(self, stage: str, error: Exception):
+        self.stage = stage
+        self.error = error
+
+    def __repr__(self):
+        return f'StageError({self.stage!r}, {self.error!r})'
+
+
+def _run_stage(stage: Stage, queue_in: Queue, queue_out: Queue,
+               n_workers_next: int, state: dict):
+    while True:
+        message = queue_in.get()
+        if message is _SENTINEL:
+            break
+        idx, value = message
+        if not isinstance(value, StageError):
+            try:
+                value = stage.func(value)
+            except Exception as e:
+                value = StageError(stage.name, e)
+        queue_out.put((idx, value))
+
+    with state['lock']:
+        state['n_alive'] -= 1
+        if state['n_alive'] > 0:
+            return
+    for _ in range(n_workers_next):
+        queue_out.put(_SENTINEL)
+
+
+def run_pipeline(items: Iterable, stages: List[Stage], queue_size: int=4
+                 ) -> Iterator[Tuple[Any, Any]]:
+    """
+    Pass every item through the stages, each stage running in its own
+    worker threads with a bounded queue in front of it.
+    Yields (item, result) in the order of items. When a stage raises,
+    result is a StageError and the later stages are skipped for the item.
+    """
+    queues = [Queue(maxsize=queue_size) for _ in stages] + [Queue()]
+    # Bound items in flight so that the reordering buffer cannot grow
+    # without limit while an early item is stuck in a slow stage.
+    in_flight = BoundedSemaphore(
+        queue_size * (len(stages) + 1) + sum(s.n_workers for s in stages))
+    # Items are read only as the window allows, so that a lazy query
+    # is not fetched ahead of the stages
+    pending = {}
+    failure = {}
+
+    def feed():
+        iterator = enumerate(items)
+        while True:
+            in_flight.acquire()
+            try:
+                idx, item = next(iterator)
+            except StopIteration:
+                break
+            except Exception as e:
+                failure['error'] = e
+                break
+            pending[idx] = item
+            queues[0].put((idx, item))
+        for _ in range(stages[0].n_workers):
+            queues[0].put(_SENTINEL)
+
+    threads = [Thread(target=feed, daemon=True)]
+    for i, stage in enumerate(stages):
+        n_workers_next = (stages[i + 1].n_workers
+                          if i + 1 < len(stages) else 1)
+        state = {'lock': Lock(), 'n_alive': stage.n_workers}
+        for _ in range(stage.n_workers):
+            threads.append(Thread(
+                target=_run_stage, daemon=True,
+                args=(stage, queues[i], queues[i + 1], n_workers_next, state)))
+    for thread in threads:
+        thread.start()
+
+    finished = {}
+    idx_next = 0
+    while True:
+        message = queues[-1].get()
+        if message is _SENTINEL:
+            break
+        idx, value = message
+        finished[idx] = value
+        while idx_next in finished:
+            in_flight.release()
+            yield pending.pop(idx_next), finished.pop(idx_next)
+            idx_next += 1
+    if 'error' in failure:
+        raise failure['error']
@@ -1,45 +1,74 @@
 from typing import List, Dict
+from functools import lru_cache
 import re
 
 
-def _extr_authors_asbib(authors: List[Dict] | None) -> str:
-    def extr_lastname(name: str):
-        PREPOSITIONS = [
-            "da", "de", "degli", "del", "della", "des", "de la", "de las",
-            "de los", "el", "di", "du", "la", "le", "l'", "van", "van de",
-            "van den", "van der", "von", "von dem", "von der", "zu",
-            "zu der", 
-        ]
-        prepositions_ = [prepo.replace(' ', '_') for prepo in PREPOSITIONS]
-
-        for preposition in PREPOSITIONS:
-            before = ' ' + preposition + ' '
-            after = ' ' + preposition.replace(' ', '_') + ' '
-            name = re.sub(r'\b' + re.escape(before) + r'\b', after, name)
-
-        preposition = ''
-        for preposit_ in prepositions_:
-            preposit_ = ' ' + preposit_ + ' '
-            match = re.search(preposit_, name)
-            if match:
-                preposition = match.group(0).replace('_', ' ')[1:]  # remove head space
-        return preposition + name.split()[-1]
+PREPOSITIONS = [
+    "da", "de", "degli", "del", "della", "des", "de la", "de las",
+    "de los", "el", "di", "du", "la", "le", "l'", "van", "van de",
+    "van den", "van der", "von", "von dem", "von der", "zu",
+    "zu der",
+]
+_PREPOSITIONS_ = [prepo.replace(' ', '_') for prepo in PREPOSITIONS]
+# Prepositions of several words are joined with '_' in one pass. The
+# callback keeps what the former pass per preposition, in the order of
+# the list, did: a match starting within the previous match of the same
+# preposition is left as is, and "van de" is not joined when the "de la",
+# "de las" or "de los" it overlaps, which come first in the list, is.
+_MULTIWORD = [prepo for prepo in PREPOSITIONS if ' ' in prepo]
+_MULTIWORD_RE = re.compile(
+    r'(?<=\w) ('
+    + '|'.join(re.escape(prepo) + (r'(?! (?:la|las|los) \w)'
+                                   if prepo == 'van de' else '')
+               for prepo in _MULTIWORD)
+    + r')(?= \w)')
+# A space followed by a preposition, each position matched apart as the
+# spaces around prepositions may be shared
+_PREPOSITION_RE = re.compile(
+    ' (?=(' + '|'.join(re.escape(prepo_) for prepo_ in _PREPOSITIONS_)
+    + ') )')
+_PREPOSITION_ORDER = {prepo_: i for i, prepo_ in enumerate(_PREPOSITIONS_)}
+
+
+def _join_multiword(name: str) -> str:
+    ends = {}  # End of the last match by preposition, with trailing space
+
+    def join(match: re.Match) -> str:
+        if match.start() < ends.get(match[1], 0):
+            return match[0]
+        ends[match[1]] = match.end() + 1
+        return ' ' + match[1].replace(' ', '_')
+
+    return _MULTIWORD_RE.sub(join, name)
+
 
+def _extr_lastname(name: str) -> str:
+    # Names without any preposition, most of names, have nothing to join
+    if not _PREPOSITION_RE.search(name):
+        return name.split()[-1]
+    name = _join_multiword(name)
+    # The preposition latest in the list wins, wherever it is in the name
+    preposition = max(_PREPOSITION_RE.findall(name),
+                      key=_PREPOSITION_ORDER.__getitem__)
+    return preposition.replace('_', ' ') + ' ' + name.split()[-1]
+
+
+@lru_cache(maxsize=65536)  # Same authors appear over the library
+def _format_author(name: str) -> str:
+    lastname = _extr_lastname(name)
+    firstnames = name.replace(lastname, '').rstrip()
+    lastname = lastname.replace('_', ' ')
+    if ' ' in lastname:
+        lastname = '{' + lastname + '}'
+    if firstnames:
+        return f'{lastname}, {firstnames}'
+    return lastname
+
+
+def _extr_authors_asbib(authors: List[Dict] | None) -> str:
     if authors is None:
         return ''
-    names = []
-    for author in authors:
-        name = author['name']
-        lastname = extr_lastname(name)
-        firstnames = name.replace(lastname, '').rstrip()
-        lastname = lastname.replace('_', ' ')
-        if ' ' in lastname:
-            lastname = '{' + lastname + '}'
-        if firstnames:
-            names.append(f'{lastname}, {firstnames}')
-        else:
-            names.append(lastname)
-    return ' and '.join(names)
+    return ' and '.join(_format_author(author['name']) for author in authors)
 
 
 def _extr_propvalue(prop: Dict, proptype: str) -> str:
@@ -0,0 +1,135 @@
+from typing import Any, Dict, Optional
+from threading import Lock
+from random import uniform
+from time import monotonic, sleep
+
+import httpx
+from notion_client import Client
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+from . import trace
+
+
+NOTION_RATE = 3.  # requests per second allowed per integration
+RETRY_STATUSES = (409, 429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """rate: tokens added per second, capacity: burst size"""
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+        self._not_before = 0.
+        self._lock = Lock()
+
+    def acquire(self) -> float:
+        """Wait for a token. Returns seconds waited."""
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Tokens may go negative; it reserves the slot of later callers
+            self._tokens -= 1
+            wait = max(-self._tokens / self.rate, self._not_before - now, 0.)
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """Hold every caller, e.g. after the server asked to slow down"""
+        with self._lock:
+            self._not_before = max(self._not_before, monotonic() + seconds)
+
+
+NOTION_BUCKET = TokenBucket(NOTION_RATE, NOTION_RATE)
+
+
+class ThrottledClient(Client):
+    """
+    Notion client sending every request through a shared token bucket.
+    Retries 429 (honouring Retry-After), conflicts, 5xx and timeouts
+    with jittered exponential backoff.
+    """
+    def __init__(self, *args, bucket: TokenBucket=NOTION_BUCKET,
+                 max_retries: int=5, backoff: float=1., **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._counters = dict(requests=0, retries=0, rate_limited=0,
+                              server_errors=0, timeouts=0, waited_sec=0.)
+        self._lock_counters = Lock()
+        self.client.event_hooks['response'].append(self._count_bytes)
+
+    @property
+    def counters(self) -> Dict[str, float]:
+        with self._lock_counters:
+            return dict(self._counters)
+
+    def _count(self, key: str, value: float=1):
+        with self._lock_counters:
+            self._counters[key] += value
+        trace.count('notion', **{key: value})
+
+    def _count_bytes(self, response: httpx.Response):
+        if not trace.is_enabled():
+            return
+        response.read()
+        trace.count('notion', bytes_received=len(response.content),
+                    bytes_sent=int(response.request.headers.get(
+                        'Content-Length', 0)))
+
+    def request(self, path: str, method: str,
+                query: Optional[Dict[Any, Any]]=None,
+                body: Optional[Dict[Any, Any]]=None,
+                form_data: Optional[Dict[Any, Any]]=None,
+                auth: Optional[str]=None) -> Any:
+        for attempt in range(self.max_retries + 1):
+            self._count('waited_sec', self.bucket.acquire())
+            self._count('requests')
+            try:
+                return super().request(
+                    path, method, query, body, form_data, auth)
+            except HTTPResponseError as e:
+                if (e.status not in RETRY_STATUSES) or \
+                   (attempt == self.max_retries):
+                    raise
+                wait = self._wait_before_retry(attempt, e)
+            except (RequestTimeoutError, httpx.TransportError):
+                if attempt == self.max_retries:
+                    raise
+                self._count('timeouts')
+                wait = self._wait_before_retry(attempt)
+            self._count('retries')
+            _rewind_files(form_data)
+            sleep(wait)
+
+    def _wait_before_retry(self, attempt: int,
+                           error: Optional[HTTPResponseError]=None) -> float:
+        wait = self.backoff * 2 ** attempt * uniform(.5, 1.5)
+        if error is None:
+            return wait
+        if error.status >= 500:
+            self._count('server_errors')
+        if error.status != 429:
+            return wait
+        self._count('rate_limited')
+        try:
+            wait = float(error.headers.get('Retry-After', wait))
+        except ValueError:
+            pass
+        self.bucket.pause(wait)
+        return wait
+
+
+def _rewind_files(form_data: Optional[Dict[Any, Any]]):
+    """Files already read by a failed request are sent again from start"""
+    for value in (form_data or {}).values():
+        if isinstance(value, tuple) and len(value) >= 2:
+            value = value[1]
+        if hasattr(value, 'seek'):
+            value.seek(0)
@@ -0,0 +1,140 @@
+"""
+Where papnt spends its time: spans around stages, and counters of
+requests, bytes and retries per external service. Nothing is recorded
+until TRACER is enabled, e.g. by `papnt --profile`.
+"""
+from typing import Any, Callable, Dict, List, Optional
+from collections import Counter, defaultdict
+from functools import wraps
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from math import ceil
+import json
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer: 'Tracer', name: str):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer._record(self.name, perf_counter() - self.start)
+        return False
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile, q in [0, 1]"""
+    return sorted_values[max(ceil(q * len(sorted_values)) - 1, 0)]
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.profiler = None  # cProfile of the CPU-bound conversion
+        self._durations: Dict[str, List[float]] = defaultdict(list)
+        self._counters: Dict[str, Counter] = defaultdict(Counter)
+        self._lock = Lock()
+        self._lock_profiler = Lock()
+        self._start = perf_counter()
+
+    def enable(self, profile_cpu: bool=False):
+        self.enabled = True
+        self._start = perf_counter()
+        if profile_cpu:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    def span(self, name: str):
+        """Context manager recording its duration under name"""
+        return _Span(self, name) if self.enabled else _NO_SPAN
+
+    def count(self, service: str, **values: float):
+        """e.g. count('notion', requests=1, bytes_sent=1024)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[service].update(values)
+
+    def profiled(self, func: Callable, *args, **kwargs) -> Any:
+        """Call func under the profiler if any. A profiler follows only
+        the thread enabling it, so profiled calls run one at a time."""
+        if self.profiler is None:
+            return func(*args, **kwargs)
+        with self._lock_profiler:
+            return self.profiler.runcall(func, *args, **kwargs)
+
+    def _record(self, name: str, duration: float):
+        with self._lock:
+            self._durations[name].append(duration)
+
+    def report(self, **info) -> Dict:
+        """Latencies (sec) by stage and counters by service"""
+        with self._lock:
+            stages = {}
+            for name, durations in sorted(self._durations.items()):
+                durations = sorted(durations)
+                stages[name] = {
+                    'count': len(durations), 'total': sum(durations),
+                    'p50': _percentile(durations, .5),
+                    'p95': _percentile(durations, .95),
+                    'max': durations[-1]}
+            services = {service: dict(counter) for service, counter
+                        in sorted(self._counters.items())}
+        return info | {'elapsed': perf_counter() - self._start,
+                       'stages': stages, 'services': services}
+
+    def save(self, save_path_json: Optional[str | Path]=None,
+             save_path_pstats: Optional[str | Path]=None, **info):
+        if save_path_json:
+            with open(save_path_json, 'w') as f:
+                json.dump(self.report(**info), f, indent=2)
+        if save_path_pstats and self.profiler:
+            self.profiler.dump_stats(save_path_pstats)
+
+
+TRACER = Tracer()
+
+
+def span(name: str):
+    return TRACER.span(name)
+
+
+def count(service: str, **values: float):
+    TRACER.count(service, **values)
+
+
+def profiled(func: Callable, *args, **kwargs) -> Any:
+    return TRACER.profiled(func, *args, **kwargs)
+
+
+def is_enabled() -> bool:
+    return TRACER.enabled
+
+
+def traced(name: str) -> Callable:
+    """Decorator recording each call as a span"""
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with TRACER.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,16 +1,44 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
+import subprocess
+import sys
 import shutil
-from tempfile import mkdtemp
+from random import random
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp, TemporaryDirectory
 from pathlib import Path
 import tomllib
+import json
+import re
 
+import httpx
+from bibtexparser.bwriter import BibTexWriter
+from bibtexparser.bibdatabase import BibDatabase
+import pymupdf
 from click.testing import CliRunner
 
 from papnt.misc import load_config, save_config
 from papnt.cli import main
-from papnt.database import NotionDatabase
-from papnt.notionprop import to_notionprop, add_fileupload_prop
+from papnt.database import (
+    NotionDatabase, _pack_paragraphs, _batch_children)
+from papnt.notionprop import (
+    to_notionprop, add_fileupload_prop, make_citekey, ArxivBatcher,
+    CitekeyIndex, NotionPropMaker)
+from papnt.cache import DiskCache, file_sha256
+from papnt.mirror import LocalMirror
+from papnt.prop2entry import notionprop_to_entry, _extr_authors_asbib
+from papnt.dedup import DedupIndex, normalize_doi
+from papnt.abbrlister import AbbrLister
+import papnt.mainfunc as mainfunc
+from papnt.ratelimit import ThrottledClient, TokenBucket
+from papnt.pdf2text import tei2children, pdf2children, PDF2ChildrenConverter
+from papnt.pipeline import Stage, StageError, run_pipeline
+from papnt.pdf2doi import extract_doi
+from papnt.trace import Tracer
+from papnt.journal import Journal, default_journal_path
+from benchmarks.bench_e2e import Bench
+from benchmarks.fakes import fake_work, template_config
 
 
 TEST_GROBID = False
@@ -192,5 +220,973 @@ class TestPapntCLI(unittest.TestCase):
                 print(result.exception)
             self.assertEqual(result.exit_code, 0)
 
+
+class TestPipeline(unittest.TestCase):
+    def test_order_and_failure(self):
+        def slow_square(x):
+            sleep(random() / 100)
+            return x * x
+
+        def fail_on_nine(x):
+            if x == 9:
+                raise ValueError('nine')
+            return x
+
+        stages = [Stage('square', slow_square, 4),
+                  Stage('check', fail_on_nine, 2),
+                  Stage('negate', lambda x: -x, 3)]
+        results = list(run_pipeline(range(20), stages, queue_size=2))
+        self.assertEqual([item for item, _ in results], list(range(20)))
+        self.assertIsInstance(results[3][1], StageError)
+        self.assertEqual(results[3][1].stage, 'check')
+        self.assertEqual(results[4][1], -16)
+
+    def test_lazy_input(self):
+        n_consumed = []
+
+        def generate():
+            for i in range(1000):
+                n_consumed.append(i)
+                yield i
+
+        results = run_pipeline(generate(), [Stage('id', lambda x: x, 2)],
+                               queue_size=2)
+        self.assertEqual(next(results), (0, 0))
+        self.assertLess(len(n_consumed), 20)
+        self.assertEqual(len(list(results)), 999)
+
+    def test_input_error(self):
+        def generate():
+            yield 1
+            raise RuntimeError('query failed')
+
+        results = run_pipeline(generate(), [Stage('id', lambda x: x)])
+        self.assertEqual(next(results), (1, 1))
+        with self.assertRaises(RuntimeError):
+            next(results)
+
+
+class TestSchemaCache(unittest.TestCase):
+    def setUp(self):
+        self.dir_cache = Path(mkdtemp())
+        self.database = NotionDatabase('', 'db-id', DiskCache(self.dir_cache))
+        self.database.notion = MagicMock()
+        self.database.notion.databases.retrieve.return_value = {
+            'data_sources': [{'id': 'ds-id'}]}
+        self.database.notion.data_sources.retrieve.return_value = {
+            'properties': {'DOI': {'type': 'rich_text'},
+                           'info': {'type': 'checkbox'}}}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_cache)
+
+    def test_retrieve_once(self):
+        self.assertEqual(self.database.data_source_id, 'ds-id')
+        database = NotionDatabase('', 'db-id', DiskCache(self.dir_cache))
+        database.notion = MagicMock()
+        self.assertEqual(database.data_source_id, 'ds-id')
+        database.notion.databases.retrieve.assert_not_called()
+
+    def test_iter_records(self):
+        self.database.notion.data_sources.query.side_effect = [
+            {'results': [1, 2], 'has_more': True, 'next_cursor': 'c'},
+            {'results': [3], 'has_more': False}]
+        records = self.database.iter_records()
+        self.assertEqual(next(records), 1)
+        self.database.notion.data_sources.query.assert_called_once()
+        self.assertEqual(list(records), [2, 3])
+
+    def test_check_propnames(self):
+        self.database.check_propnames({'doi': 'DOI'})
+        with self.assertRaises(ValueError):
+            self.database.check_propnames({'doi': 'DOI', 'pdf': 'PDF'})
+        self.assertEqual(
+            self.database.notion.databases.retrieve.call_count, 2)
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.dir_cache = Path(mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_cache)
+
+    def test_ttl(self):
+        cache = DiskCache(self.dir_cache, ttl=-1)
+        cache.set('key', 1)
+        self.assertIsNone(cache.get('key'))
+
+    def test_negative_and_eviction(self):
+        cache = DiskCache(self.dir_cache, max_entries=2, negative_ttl=-1)
+        cache.set('missing', None)
+        self.assertEqual(cache.get('missing', 'expired'), 'expired')
+        for key in ('a', 'b', 'c'):
+            cache.set(key, key)
+        self.assertEqual(len(list(self.dir_cache.glob('*.json'))), 2)
+
+    def test_compress_and_max_bytes(self):
+        cache = DiskCache(self.dir_cache, max_bytes=3000, compress=True)
+        for i in range(10):
+            cache.set(str(i), [random() for _ in range(50)])
+        paths = list(self.dir_cache.glob('*.json.gz'))
+        self.assertLessEqual(sum(p.stat().st_size for p in paths), 3000)
+        self.assertIsNotNone(cache.get('9'))
+        self.assertIsNone(cache.get('0'))
+
+    def test_coalescing(self):
+        cache = DiskCache(self.dir_cache)
+        fetch = MagicMock(side_effect=lambda: sleep(0.1) or 'info')
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(
+                lambda _: cache.get_or_fetch('doi', fetch), range(4)))
+        self.assertEqual(results, ['info'] * 4)
+        fetch.assert_called_once()
+
+    def test_entries_of_other_format(self):
+        DiskCache(self.dir_cache).set('old', 'x' * 1000)
+        cache = DiskCache(self.dir_cache, max_bytes=1500, compress=True)
+        cache.set('new', [random() for _ in range(50)])
+        self.assertEqual(list(self.dir_cache.glob('*.json')), [])
+        self.assertIsNotNone(cache.get('new'))
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.dir_cache = Path(mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_cache)
+
+    def test_crossref_fields(self):
+        doi = '10.5555/cache.00001'
+        work = fake_work(doi)
+        work['reference'] = [{'key': f'ref{i}', 'DOI': f'10.1/{i}'}
+                             for i in range(500)]
+        work['author'][0]['affiliation'] = [{'name': 'Somewhere'}]
+        propnames = template_config()['propnames']
+        cache = DiskCache(self.dir_cache, compress=True)
+        with patch('crossref.restful.Works') as works:
+            works.return_value.doi.return_value = work
+            prop = NotionPropMaker(cache).from_doi(doi, propnames)
+            self.assertEqual(
+                NotionPropMaker(cache).from_doi(doi, propnames), prop)
+            works.return_value.doi.assert_called_once()
+
+        info = cache.get(f'crossref:{doi}')
+        self.assertNotIn('reference', info)
+        self.assertNotIn('affiliation', info['author'][0])
+        self.assertEqual(info['title'], work['title'])
+
+
+class TestArxivBatcher(unittest.TestCase):
+    def test_fetch_many_at_once(self):
+        def make_paper(short_id):
+            paper = MagicMock()
+            paper.get_short_id.return_value = short_id
+            return paper
+
+        batcher = ArxivBatcher()
+        batcher._client = MagicMock()
+        batcher._client.results.return_value = [
+            make_paper('2101.00001v2'), make_paper('2101.00002v1')]
+        papers = batcher.fetch(['2101.00001', '2101.00002v1', '2101.00003'])
+        batcher._client.results.assert_called_once()
+        self.assertEqual(papers['2101.00001'].get_short_id(), '2101.00001v2')
+        self.assertIsNotNone(papers['2101.00002v1'])
+        self.assertIsNone(papers['2101.00003'])
+
+
+class TestFileUpload(unittest.TestCase):
+    def test_multi_part(self):
+        dir_temp = Path(mkdtemp())
+        self.addCleanup(shutil.rmtree, dir_temp)
+        load_path_pdf = dir_temp / 'thesis.pdf'
+        content = bytes(range(256)) * 2
+        load_path_pdf.write_bytes(content)
+
+        parts = {}
+        notion = MagicMock()
+        notion.file_uploads.create.return_value = {'id': 'upload-id'}
+        notion.file_uploads.send.side_effect = lambda **kwargs: parts.update(
+            {kwargs['part_number']: kwargs['file'][1].read()})
+        notion.file_uploads.complete.return_value = {'status': 'uploaded'}
+        with patch('papnt.notionprop.SINGLE_PART_MAX_BYTES', 300), \
+             patch('papnt.notionprop.PART_BYTES', 100):
+            prop = add_fileupload_prop({}, load_path_pdf, notion, 'PDF')
+
+        notion.file_uploads.create.assert_called_once_with(
+            mode='multi_part', filename='thesis.pdf',
+            content_type='application/pdf', number_of_parts=6)
+        self.assertEqual(sorted(parts), [str(i) for i in range(1, 7)])
+        self.assertEqual(
+            b''.join(parts[str(i)] for i in range(1, 7)), content)
+        self.assertEqual(
+            prop['PDF']['files'][0]['file_upload']['id'], 'upload-id')
+
+
+class TestThrottledClient(unittest.TestCase):
+    def test_retry(self):
+        statuses = [429, 503, 200]
+
+        def handler(request):
+            status = statuses.pop(0)
+            if status == 200:
+                return httpx.Response(200, json={'object': 'page'})
+            return httpx.Response(
+                status, headers={'Retry-After': '0'},
+                json={'object': 'error', 'code': 'rate_limited',
+                      'message': ''})
+
+        notion = ThrottledClient(
+            client=httpx.Client(transport=httpx.MockTransport(handler)),
+            bucket=TokenBucket(100, 100), backoff=0)
+        self.assertEqual(notion.pages.retrieve('page-id'), {'object': 'page'})
+        counters = notion.counters
+        self.assertEqual(counters['requests'], 3)
+        self.assertEqual(counters['retries'], 2)
+        self.assertEqual(counters['rate_limited'], 1)
+        self.assertEqual(counters['server_errors'], 1)
+
+    def test_bucket_rate(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+        waited = sum(bucket.acquire() for _ in range(6))
+        self.assertGreater(waited, 0.08)
+
+
+class TestBlockPacker(unittest.TestCase):
+    @staticmethod
+    def make_paragraph(text: str) -> dict:
+        return {'object': 'block',
+                'paragraph': {'rich_text': [{'text': {'content': text}}]}}
+
+    def test_pack_paragraphs(self):
+        heading = {'object': 'block', 'type': 'heading_1',
+                   'heading_1': {'rich_text': []}}
+        children = [self.make_paragraph(str(i)) for i in range(60)]
+        packed = _pack_paragraphs(children[:2] + [heading] + children[2:])
+        self.assertEqual(len(packed), 3 + 1)
+        self.assertEqual(
+            [text['text']['content'] for text
+             in packed[0]['paragraph']['rich_text']], ['0', '\n', '1'])
+        self.assertEqual(len(packed[2]['paragraph']['rich_text']), 99)
+
+    def test_batch_children(self):
+        children = [self.make_paragraph('x' * 2000) for _ in range(250)]
+        batches = list(_batch_children(children))
+        self.assertEqual([len(batch) for batch in batches], [100] * 2 + [50])
+        table = {'type': 'table', 'table': {
+            'table_width': 1, 'children': [{'type': 'table_row'}] * 400}}
+        batches = list(_batch_children([table] * 3))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+
+
+class TestTEIConverter(unittest.TestCase):
+    def test_golden(self):
+        # Golden JSON files were written by the former BeautifulSoup
+        # converter from the same TEI files. Since then only captions and
+        # tables moved next to the first paragraph referring to them.
+        for load_path in Path('tests/testdata/tei').glob('*.tei.xml'):
+            load_path_golden = load_path.with_name(
+                load_path.name.replace('.tei.xml', '.json'))
+            with self.subTest(load_path.name):
+                golden = json.loads(load_path_golden.read_text())
+                self.assertEqual(
+                    tei2children(load_path.read_text()), golden)
+
+    def test_cache(self):
+        dir_temp = Path(mkdtemp())
+        self.addCleanup(shutil.rmtree, dir_temp)
+        load_path_pdf = dir_temp / 'paper.pdf'
+        load_path_pdf.write_bytes(b'%PDF-1.4 dummy')
+        load_path_tei = Path('tests/testdata/tei/article.tei.xml')
+        client = MagicMock()
+        client.process_pdf.return_value = (
+            str(load_path_pdf), 200, load_path_tei.read_text())
+        cache = DiskCache(dir_temp / 'cache', compress=True)
+
+        children = pdf2children(client, load_path_pdf, cache)
+        self.assertEqual(children, tei2children(load_path_tei.read_text()))
+        # Same content under another name is not sent to GROBID again
+        load_path_copy = load_path_pdf.with_name('copy.pdf')
+        shutil.copy(load_path_pdf, load_path_copy)
+        self.assertEqual(pdf2children(client, load_path_copy, cache), children)
+        client.process_pdf.assert_called_once()
+        self.assertEqual(file_sha256(load_path_copy),
+                         file_sha256(load_path_pdf))
+
+        client.process_pdf.return_value = (str(load_path_pdf), 503, 'busy')
+        load_path_pdf.write_bytes(b'%PDF-1.4 another')
+        with self.assertRaises(RuntimeError):
+            pdf2children(client, load_path_pdf, cache)
+        self.assertEqual(len(list((dir_temp / 'cache').glob('*.gz'))), 2)
+
+    def test_convert_many(self):
+        converter = PDF2ChildrenConverter('', n_parallel=2)
+        converter.client = MagicMock()
+        n_running, max_running = 0, 0
+        consumed = []
+
+        def convert(load_path_pdf):
+            nonlocal n_running, max_running
+            n_running += 1
+            max_running = max(max_running, n_running)
+            sleep(random() / 50)
+            n_running -= 1
+            return [load_path_pdf]
+
+        def paths():
+            for i in range(8):
+                consumed.append(i)
+                yield i
+
+        with patch.object(converter, 'convert', side_effect=convert):
+            results = dict(converter.convert_many(paths()))
+        self.assertEqual(results, {i: [i] for i in range(8)})
+        self.assertLessEqual(max_running, 2)
+        self.assertEqual(consumed, list(range(8)))
+
+
+class TestDOIExtractor(unittest.TestCase):
+    def setUp(self):
+        self.dir_temp = Path(mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_temp)
+
+    def make_pdf(self, name: str, text: str='', metadata: dict={}) -> Path:
+        save_path = self.dir_temp / name
+        with pymupdf.open() as document:
+            document.new_page().insert_text((72, 72), text)
+            document.set_metadata(metadata)
+            document.save(save_path)
+        return save_path
+
+    def test_testdata(self):
+        for load_path in Path('tests/testdata').glob('*.pdf'):
+            with self.subTest(load_path.name):
+                info = extract_doi(load_path, fallback=False)
+                self.assertIsNotNone(info['identifier'])
+                self.assertIn(info['method'], ('metadata', 'xmp', 'text_p1'))
+
+    def test_sources(self):
+        cases = [
+            (self.make_pdf('a.pdf', metadata={'subject': 'doi:10.1234/ab.c'}),
+             '10.1234/ab.c', 'metadata'),
+            (self.make_pdf('b.pdf', 'Published as https://doi.org/10.1234/x1).'),
+             '10.1234/x1', 'text_p1'),
+            (self.make_pdf('c.pdf', 'Preprint arXiv:2101.00001v2 [cs.LG]'),
+             '10.48550/arXiv.2101.00001', 'text_p1'),
+            (self.make_pdf('2301.12345v1.pdf'),
+             '10.48550/arXiv.2301.12345', 'filename'),
+            (self.make_pdf('10.1038_s41598-023-29854-9.pdf'),
+             '10.1038/s41598-023-29854-9', 'filename'),
+            (self.make_pdf('d.pdf', 'arXiv:2113.00001 is not an ID'),
+             None, None),
+            (self.make_pdf('1412.12345.pdf'), None, None)]
+        for load_path, identifier, method in cases:
+            with self.subTest(load_path.name):
+                info = extract_doi(load_path, fallback=False)
+                self.assertEqual(info['identifier'], identifier)
+                self.assertEqual(info['method'], method)
+
+
+class TestLocalMirror(unittest.TestCase):
+    def setUp(self):
+        self.dir_temp = Path(mkdtemp())
+        self.mirror = LocalMirror(self.dir_temp / 'mirror.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_temp)
+
+    @staticmethod
+    def make_page(id_: str, edited: str, info: bool, targets: list):
+        return {'id': id_, 'last_edited_time': edited, 'properties': {
+            'info': {'checkbox': info},
+            'DOI': {'rich_text': [{'plain_text': f'10.1/{id_}'}]},
+            'Cite in': {'multi_select': [{'name': t} for t in targets]}}}
+
+    def test_sync_and_query(self):
+        database = MagicMock()
+        database.iter_records.return_value = iter([
+            self.make_page('a', '2024-01-01T00:00:00.000Z', False, ['x']),
+            self.make_page('b', '2024-01-02T00:00:00.000Z', True, ['x', 'y'])])
+        self.assertEqual(self.mirror.sync(database), 2)
+        self.assertEqual(self.mirror.watermark, '2024-01-02T00:00:00.000Z')
+
+        database.iter_records.return_value = iter([
+            self.make_page('a', '2024-01-03T00:00:00.000Z', True, ['y'])])
+        self.mirror.sync(database)
+        self.assertEqual(
+            database.iter_records.call_args.args[0]['last_edited_time'],
+            {'on_or_after': '2024-01-02T00:00:00.000Z'})
+
+        notionfilter = {
+            'and': [{'property': 'info', 'checkbox': {'equals': True}},
+                    {'property': 'DOI', 'rich_text': {'is_not_empty': True}},
+                    {'property': 'Cite in', 'multi_select': {'contains': 'y'}}]}
+        ids = [record['id'] for record
+               in self.mirror.iter_records(notionfilter)]
+        self.assertEqual(sorted(ids), ['a', 'b'])
+        notionfilter = {'property': 'Cite in', 'multi_select': {'contains': 'x'}}
+        ids = [record['id'] for record
+               in self.mirror.iter_records(notionfilter)]
+        self.assertEqual(ids, ['b'])
+
+    def test_texts(self):
+        for id_ in ('a', 'b', 'c'):
+            self.mirror.upsert(self.make_page(
+                id_, '2024-01-01T00:00:00.000Z', False, []))
+        page = self.make_page('d', '2024-01-01T00:00:00.000Z', False, [])
+        page['properties']['DOI'] = {'rich_text': []}
+        self.mirror.upsert(page)
+        page = self.make_page('a', '2024-01-02T00:00:00.000Z', False, [])
+        page['properties']['DOI']['rich_text'].append({'plain_text': 'x'})
+        self.mirror.upsert(page)
+        self.assertEqual(list(self.mirror.iter_texts('DOI')),
+                         [('b', '10.1/b'), ('c', '10.1/c'), ('a', '10.1/ax')])
+        self.assertEqual(
+            CitekeyIndex.from_mirror(self.mirror, 'DOI')._citekeys,
+            CitekeyIndex.from_records(
+                self.mirror.iter_records(), 'DOI')._citekeys)
+
+
+
+class TestAuthorFormatter(unittest.TestCase):
+    def test_golden(self):
+        # Written by the former formatter, which ran the regex of every
+        # preposition over each name
+        with open('tests/testdata/authors.json', encoding='UTF-8') as f:
+            cases = json.load(f)
+        for case in cases:
+            authors = case['names'] and [{'name': name}
+                                         for name in case['names']]
+            with self.subTest(case['names']):
+                self.assertEqual(_extr_authors_asbib(authors), case['bib'])
+
+
+class TestCitekey(unittest.TestCase):
+    def test_golden(self):
+        # Written by the former generator, which replaced skipwords in
+        # the title until nothing changed
+        with open('tests/testdata/citekeys.json', encoding='UTF-8') as f:
+            cases = json.load(f)
+        for case in cases:
+            with self.subTest(case['title']):
+                self.assertEqual(
+                    make_citekey(case['lastname'], case['title'], case['year']),
+                    case['citekey'])
+
+    def test_index(self):
+        records = [{'id': 'page-a', 'properties': {'Citekey': {'rich_text': [
+            {'plain_text': 'smith2020'}]}}}]
+        index = CitekeyIndex.from_records(records, 'Citekey')
+        self.assertEqual(
+            index.assign(['smith2020', 'smith2020', 'jones2020', 'smith2020'],
+                         [None, 'page-a', None, None]),
+            ['smith2020a', 'smith2020', 'jones2020', 'smith2020b'])
+        index.assign(['lee2020'] + ['lee2020'] * 27)
+        self.assertEqual(index.assign(['lee2020']), ['lee2020ab'])
+
+
+class TestAbbrLister(unittest.TestCase):
+    def test_cache_and_spec(self):
+        dir_temp = Path(mkdtemp())
+        self.addCleanup(shutil.rmtree, dir_temp)
+        cache = DiskCache(dir_temp / 'abbr')
+        entries = [{'journal': 'Journal of Neuroscience'},
+                   {'journal': 'PLOS ONE'}, {'journal': 'PLOS ONE'}, {}]
+        spec = {'PLOS ONE': 'PLOS ONE'}
+        save_path = dir_temp / 'target.json'
+
+        with patch('papnt.abbrlister._prepare_wordnet') as prepare, \
+             patch('iso4.abbreviate',
+                   side_effect=lambda name: name[:5] + '.  X') as abbreviate:
+            for _ in range(2):
+                AbbrLister(entries, cache).listup(spec).save(save_path)
+        self.assertEqual(abbreviate.call_count, 2)  # Once for each journal
+        prepare.assert_called()
+        self.assertEqual(
+            json.loads(save_path.read_text())['default']['container-title'],
+            {'Journal of Neuroscience': 'Journ. X', 'PLOS ONE': 'PLOS ONE'})
+
+
+class TestMakeBib(unittest.TestCase):
+    PROPNAMES = {
+        'doi': 'DOI', 'author': 'Authors', 'title': 'Title',
+        'edition': 'Edition', 'year': 'Year', 'journal': 'Journal',
+        'volume': 'Volume', 'pages': 'Pages', 'publisher': 'Publisher',
+        'id': 'Citekey', 'entrytype': 'Type', 'howpublished': 'HowPublished',
+        'output_target': 'Cite in', 'pdf': 'PDF'}
+
+    def setUp(self):
+        self.dir_temp = Path(mkdtemp())
+        self.mirror = LocalMirror(self.dir_temp / 'mirror.sqlite')
+        self.cache = DiskCache(self.dir_temp / 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_temp)
+
+    @staticmethod
+    def make_page(citekey: str, targets: list) -> dict:
+        def rich_text(text):
+            return {'rich_text': [{'plain_text': text}] if text else []}
+
+        return {
+            'id': citekey, 'last_edited_time': '2024-01-01T00:00:00.000Z',
+            'properties': {
+                'Type': {'select': {'name': 'article'}},
+                'Citekey': rich_text(citekey), 'Title': rich_text(citekey),
+                'Authors': {'multi_select': [{'name': 'Ada Lovelace'}]},
+                'Journal': {'select': {'name': 'Nature'}},
+                'Year': {'number': 2024}, 'DOI': rich_text(f'10.1/{citekey}'),
+                'Edition': rich_text(''), 'Volume': rich_text(''),
+                'Pages': rich_text(''), 'Publisher': {'select': None},
+                'HowPublished': rich_text(''), 'PDF': {'files': []},
+                'Cite in': {'multi_select': [{'name': t} for t in targets]}}}
+
+    def test_fan_out(self):
+        for citekey, targets in (('a', ['x']), ('b', ['x', 'y']),
+                                 ('c', ['z']), ('d', [])):
+            self.mirror.upsert(self.make_page(citekey, targets))
+
+        def citekeys(save_path_bib: Path) -> list:
+            return re.findall(r'@article\{(\w+),', save_path_bib.read_text())
+
+        save_paths_bib = mainfunc.make_bibfiles_from_records(
+            self.mirror, ['x', 'y', 'w'], self.PROPNAMES, self.dir_temp,
+            self.cache)
+        self.assertEqual(
+            {target: citekeys(path) for target, path in save_paths_bib.items()},
+            {'x': ['a', 'b'], 'y': ['b'], 'w': []})
+
+        save_paths_bib = mainfunc.make_bibfiles_from_records(
+            self.mirror, None, self.PROPNAMES, self.dir_temp, self.cache)
+        self.assertEqual(sorted(save_paths_bib), ['x', 'y', 'z'])
+
+    def test_incremental(self):
+        pages = [self.make_page(citekey, ['x'])
+                 for citekey in ('Zeta', 'alpha', 'beta', 'Gamma')]
+        for page in pages:
+            self.mirror.upsert(page)
+        save_path_bib = mainfunc.make_bibfiles_from_records(
+            self.mirror, ['x'], self.PROPNAMES, self.dir_temp, self.cache)['x']
+        bib_db = BibDatabase()
+        bib_db.entries = [
+            notionprop_to_entry(page['properties'], {
+                val: key for key, val in self.PROPNAMES.items()})
+            for page in pages]
+        self.assertEqual(save_path_bib.read_text(),
+                         BibTexWriter().write(bib_db))
+
+        mtime = save_path_bib.stat().st_mtime_ns
+        with patch('papnt.prop2entry.notionprop_to_entry') as to_entry:
+            mainfunc.make_bibfiles_from_records(
+                self.mirror, ['x'], self.PROPNAMES, self.dir_temp, self.cache)
+            to_entry.assert_not_called()
+        self.assertEqual(save_path_bib.stat().st_mtime_ns, mtime)
+
+        pages[1]['last_edited_time'] = '2024-02-01T00:00:00.000Z'
+        pages[1]['properties']['Year'] = {'number': 2025}
+        self.mirror.upsert(pages[1])
+        mainfunc.make_bibfiles_from_records(
+            self.mirror, ['x'], self.PROPNAMES, self.dir_temp, self.cache)
+        self.assertIn('2025', save_path_bib.read_text())
+
+    def test_edit_within_minute(self):
+        page = self.make_page('alpha', ['x'])
+        self.mirror.upsert(page)
+        save_path_bib = mainfunc.make_bibfiles_from_records(
+            self.mirror, ['x'], self.PROPNAMES, self.dir_temp, self.cache)['x']
+
+        # Signed URLs of files change per query, without an edit
+        page['properties']['PDF'] = {'files': [
+            {'name': 'a.pdf', 'file': {'url': 'https://files/a.pdf?sig=1'}}]}
+        self.mirror.upsert(page)
+        with patch('papnt.prop2entry.notionprop_to_entry') as to_entry:
+            mainfunc.make_bibfiles_from_records(
+                self.mirror, ['x'], self.PROPNAMES, self.dir_temp, self.cache)
+            to_entry.assert_not_called()
+
+        # Notion keeps last_edited_time within the minute
+        page['properties']['Year'] = {'number': 2025}
+        self.mirror.upsert(page)
+        mainfunc.make_bibfiles_from_records(
+            self.mirror, ['x'], self.PROPNAMES, self.dir_temp, self.cache)
+        self.assertIn('2025', save_path_bib.read_text())
+
+
+class TestDedupIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir_temp = Path(mkdtemp())
+        self.mirror = LocalMirror(self.dir_temp / 'mirror.sqlite')
+        self.database = MagicMock()
+        self.database.iter_records.return_value = iter([
+            {'id': 'page-a', 'last_edited_time': '2024-01-01T00:00:00.000Z',
+             'properties': {'DOI': {'rich_text': [
+                 {'plain_text': 'https://doi.org/10.1000/ABC'}]}}}])
+        self.index = DedupIndex(self.mirror, 'DOI')
+        self.index.seed(self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_temp)
+
+    def test_normalize_doi(self):
+        for doi in ('10.1000/abc', 'doi: 10.1000/ABC', 'http://dx.doi.org/10.1000/abc',
+                    'https://doi.org//10.1000/abc '):
+            self.assertEqual(normalize_doi(doi), '10.1000/abc')
+
+    def test_claim(self):
+        path_a, path_b = Path('a.pdf'), Path('b.pdf')
+        self.assertEqual(self.index.claim(path_a, doi='10.1000/abc'), 'page-a')
+        self.assertIsNone(self.index.claim(path_a, digest='hash-a'))
+        self.assertIsNone(self.index.claim(path_a, doi='10.1000/new'))
+        self.assertEqual(self.index.claim(path_b, digest='hash-a'), path_a)
+        self.index.release(path_a)
+        self.assertIsNone(self.index.claim(path_b, doi='10.1000/new'))
+
+        # Hashes persist, but only of pages still in the mirror
+        self.index.add('page-b', 'hash-b')
+        self.index.add('page-a', 'hash-c')
+        index = DedupIndex(self.mirror, 'DOI')
+        self.database.iter_records.return_value = iter([])
+        index.seed(self.database)
+        self.assertEqual(index.claim(path_a, digest='hash-c'), 'page-a')
+        self.assertIsNone(index.claim(path_a, digest='hash-b'))
+
+    def test_seed_without_decoding(self):
+        index = DedupIndex(self.mirror, 'DOI')
+        self.database.iter_records.return_value = iter([])
+        with patch.object(self.mirror, 'iter_records',
+                          side_effect=AssertionError('pages decoded')):
+            index.seed(self.database)
+        self.assertEqual(
+            index.claim(Path('a.pdf'), doi='10.1000/abc'), 'page-a')
+
+    def test_add_records(self):
+        dir_pdf = self.dir_temp / 'pdf'
+        dir_pdf.mkdir()
+        for name in ('known.pdf', 'new.pdf'):
+            shutil.copy('tests/testdata/plos.pdf', dir_pdf / name)
+        with (dir_pdf / 'new.pdf').open('ab') as f:
+            f.write(b'\n')  # Another file of the same paper
+        self.index.add('page-a', file_sha256(dir_pdf / 'known.pdf'))
+        self.index.add('page-p', 'hash-p', '10.1371/journal.pbio.0040069')
+        self.database.create.return_value = {'id': 'page-new'}
+        self.database.update_properties.side_effect = (
+            lambda page_id, prop: {'id': page_id})
+
+        with patch.object(mainfunc, '_make_converter',
+                          return_value=MagicMock(n_parallel=1)), \
+             patch('papnt.notionprop.NotionPropMaker'), \
+             patch('papnt.notionprop.add_fileupload_prop',
+                   side_effect=lambda prop, *_: prop) as upload, \
+             patch.object(mainfunc, 'load_config', return_value={}):
+            mainfunc.add_records_from_local_pdfpath(
+                self.database, {'pdf': 'PDF'}, (dir_pdf,), self.index)
+            self.database.create.assert_not_called()
+            self.assertEqual(upload.call_count, 0)
+
+            mainfunc.add_records_from_local_pdfpath(
+                self.database, {'pdf': 'PDF'}, (dir_pdf,), self.index,
+                update_duplicates=True)
+        self.assertEqual(self.database.update_properties.call_count, 2)
+        self.assertEqual(
+            {call.args[0] for call in
+             self.database.update_properties.call_args_list},
+            {'page-a', 'page-p'})
+
+
+class TestFakeServers(unittest.TestCase):
+    """Commands end to end against local stand-ins of the services"""
+    def setUp(self):
+        self.dir_temp = Path(mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_temp)
+
+    def run_command(self, command: str, n_records: int) -> Bench:
+        with Bench(self.dir_temp, latency=0., rate_limit_every=3,
+                   notion_rate=0.) as bench:
+            getattr(bench, f'prepare_{command}')(n_records)
+            getattr(bench, f'run_{command}')()
+        self.assertGreater(bench.notion.counts['rate_limited'], 0)
+        return bench
+
+    def assert_recorded(self, bench: Bench, n_records: int):
+        pages = list(bench.notion.pages.values())
+        self.assertEqual(len(pages), n_records)
+        citekeys = set()
+        for page in pages:
+            self.assertTrue(page['properties']['info']['checkbox'])
+            citekeys.add(page['properties']['Citekey']['rich_text'][0]
+                         ['plain_text'])
+        self.assertEqual(len(citekeys), n_records)
+
+    def test_paths(self):
+        bench = self.run_command('paths', 3)
+        self.assert_recorded(bench, 3)
+        for page_id, page in bench.notion.pages.items():
+            self.assertTrue(bench.notion.children[page_id])
+            file, = page['properties']['PDF']['files']
+            self.assertTrue(bench.notion.files[
+                file['file']['url'].split('/')[-1]].startswith(b'%PDF'))
+
+    def test_doi_not_found(self):
+        with Bench(self.dir_temp, latency=0., rate_limit_every=0,
+                   notion_rate=0.) as bench:
+            bench.prepare_doi(5)
+            page = list(bench.notion.pages.values())[2]
+            page['properties']['DOI'] = {'id': 'DOI', 'type': 'rich_text',
+                                         'rich_text': [{'plain_text':
+                                                        '10.0000/unknown'}]}
+            bench.run_doi()
+        checked = [page['properties']['info']['checkbox']
+                   for page in bench.notion.pages.values()]
+        self.assertEqual(checked, [True, True, False, True, True])
+
+    def test_doi_and_pdf(self):
+        self.assert_recorded(self.run_command('doi', 5), 5)
+        shutil.rmtree(self.dir_temp)
+        self.dir_temp.mkdir()
+        bench = self.run_command('pdf', 3)
+        self.assert_recorded(bench, 3)
+        self.assertTrue(all(bench.notion.children.values()))
+
+    def test_paths_failure_to_record(self):
+        with Bench(self.dir_temp, latency=0., rate_limit_every=0,
+                   notion_rate=0.) as bench:
+            bench.prepare_paths(3)
+            create = bench.database.create
+            n_calls = []
+
+            def create_but_second(*args, **kwargs):
+                n_calls.append(1)
+                if len(n_calls) == 2:
+                    raise RuntimeError('validation_error')
+                return create(*args, **kwargs)
+
+            with patch.object(bench.database, 'create', create_but_second):
+                bench.run_paths()
+            self.assertEqual(len(bench.notion.pages), 2)
+            self.assertIn('(notion): validation_error',
+                          (bench.dir_pdf / 'skipped-files.txt').read_text())
+
+            # The claim on the PDF is released, so that it is retried
+            bench.run_paths()
+        self.assert_recorded(bench, 3)
+
+    def test_query_cursors(self):
+        with Bench(self.dir_temp, latency=0., rate_limit_every=0,
+                   notion_rate=0.) as bench:
+            bench.prepare_doi(150)
+            notionfilter = {'property': 'info', 'checkbox': {'equals': False}}
+            page_ids = []
+            for record in bench.database.iter_records(notionfilter):
+                bench.database.update_properties(record['id'], {})
+                page_ids.append(record['id'])
+        self.assertEqual(page_ids, list(bench.notion.pages))
+
+    def test_beyond_one_page(self):
+        # Updated records drop out of the query while it is being read
+        for command, n_records in (('doi', 210), ('pdf', 120)):
+            with self.subTest(command), \
+                 TemporaryDirectory() as dir_temp, \
+                 Bench(Path(dir_temp), latency=0., rate_limit_every=0,
+                       notion_rate=0.) as bench:
+                bench.notion.offset_cursors = True
+                getattr(bench, f'prepare_{command}')(n_records)
+                getattr(bench, f'run_{command}')()
+                self.assert_recorded(bench, n_records)
+
+    def test_pdf_reads_records_lazily(self):
+        n_records = 40
+        window = 4 * 2 + 4  # queue_size * (stages + 1) + workers_download
+        ahead = []
+        with Bench(self.dir_temp, latency=0.005, rate_limit_every=0,
+                   notion_rate=0.) as bench:
+            bench.prepare_pdf(n_records)
+            drain_records = bench.database.drain_records
+
+            def drain_records_watched(*args, **kwargs):
+                for i, record in enumerate(drain_records(*args, **kwargs)):
+                    n_downloads = sum(
+                        count for key, count in bench.notion.counts.items()
+                        if key.startswith('GET files'))
+                    ahead.append(i - n_downloads)
+                    yield record
+
+            with patch.object(bench.database, 'drain_records',
+                              drain_records_watched):
+                mainfunc.update_unchecked_records_from_uploadedpdf(
+                    bench.database, bench.propnames, None, bench.citekeys())
+        self.assert_recorded(bench, n_records)
+        self.assertEqual(len(ahead), n_records)
+        # Records are read only as far as downloads free the window
+        self.assertLessEqual(max(ahead), window)
+        self.assertLess(ahead[-1], n_records - 1)
+
+    def test_pdf_local(self):
+        with Bench(self.dir_temp, latency=0., rate_limit_every=0,
+                   notion_rate=0.) as bench:
+            bench.prepare_pdf(3)
+            bench.mirror.sync(bench.database)
+            # Records of the mirror are read in the thread of the pipeline
+            mainfunc.update_unchecked_records_from_uploadedpdf(
+                bench.database, bench.propnames, bench.mirror,
+                bench.citekeys())
+        self.assert_recorded(bench, 3)
+
+    def test_makebib(self):
+        bench = self.run_command('makebib', 4)
+        self.assertEqual(
+            (self.dir_temp / 'bench.bib').read_text().count('@article'), 4)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir_temp = Path(mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_temp)
+
+    def test_replay(self):
+        load_path = self.dir_temp / 'journal.jsonl'
+        with Journal(load_path) as journal:
+            journal.record('a.pdf', doi='10.1/a')
+            journal.record('a.pdf', upload={'files': []})
+            journal.record('b.pdf', doi=None)
+        with load_path.open('a') as f:
+            f.write('{"key": "a.pdf", "page_')  # Cut off by a crash
+        with Journal(load_path, resume=True) as journal:
+            self.assertEqual(journal.get('a.pdf')['doi'], '10.1/a')
+            self.assertEqual(journal.get('a.pdf')['upload'], {'files': []})
+            self.assertNotIn('page_id', journal.get('a.pdf'))
+            self.assertIsNone(journal.get('b.pdf')['doi'])
+            self.assertEqual(journal.get('c.pdf'), {})
+        # Runs not resuming keep what others recorded
+        with Journal(load_path) as journal, \
+             Journal(load_path) as journal_other:
+            self.assertEqual(journal.get('a.pdf'), {})
+            journal.record('a.pdf', page_id='page-a')
+            journal_other.record('c.pdf', page_id='page-c')
+            self.assertTrue(journal.is_complete('page_id'))
+        with Journal(load_path, resume=True) as journal:
+            self.assertEqual(journal.get('a.pdf')['doi'], '10.1/a')
+            self.assertEqual(journal.get('a.pdf')['page_id'], 'page-a')
+            self.assertEqual(journal.get('c.pdf')['page_id'], 'page-c')
+            self.assertFalse(journal.is_complete('page_id'))
+
+    def test_path_by_inputs(self):
+        paths = [Path('a.pdf'), Path('b.pdf')]
+        self.assertEqual(default_journal_path('paths', 'db', paths),
+                         default_journal_path('paths', 'db', paths[::-1]))
+        self.assertNotEqual(default_journal_path('paths', 'db', paths),
+                            default_journal_path('paths', 'db', paths[:1]))
+
+    def test_resume_paths(self):
+        n_records = 4
+        with Bench(self.dir_temp, latency=0., rate_limit_every=0,
+                   notion_rate=0.) as bench:
+            bench.prepare_paths(n_records)
+            load_path = self.dir_temp / 'journal.jsonl'
+            create = bench.database.create
+
+            def create_then_crash(*args, **kwargs):
+                if len(bench.notion.pages) == 2:
+                    raise KeyboardInterrupt
+                return create(*args, **kwargs)
+
+            with Journal(load_path) as journal, \
+                 patch.object(bench.database, 'create', create_then_crash), \
+                 self.assertRaises(KeyboardInterrupt):
+                mainfunc.add_records_from_local_pdfpath(
+                    bench.database, bench.propnames, (bench.dir_pdf,),
+                    journal=journal)
+            self.assertEqual(len(bench.notion.pages), 2)
+
+            with Journal(load_path, resume=True) as journal:
+                mainfunc.add_records_from_local_pdfpath(
+                    bench.database, bench.propnames, (bench.dir_pdf,),
+                    journal=journal)
+        self.assertEqual(len(bench.notion.pages), n_records)
+        # Each PDF uploaded once, by whichever run got to it
+        self.assertEqual(bench.notion.counts['POST v1/file_uploads'],
+                         n_records)
+        with Journal(load_path, resume=True) as journal:
+            for load_path_pdf in bench.dir_pdf.glob('*.pdf'):
+                self.assertIn('page_id', journal.get(str(load_path_pdf)))
+
+
+class TestTrace(unittest.TestCase):
+    def test_report(self):
+        tracer = Tracer()
+        with tracer.span('idle'):
+            pass
+        tracer.count('notion', requests=1)
+        self.assertEqual(tracer.report()['stages'], {})
+
+        tracer.enable()
+        for i in range(20):
+            tracer._record('stage', i / 100)
+        tracer.count('notion', requests=1, bytes_sent=10)
+        tracer.count('notion', requests=1, retries=1)
+        report = tracer.report(command='paths')
+        self.assertEqual(report['command'], 'paths')
+        self.assertEqual(report['stages']['stage']['count'], 20)
+        self.assertAlmostEqual(report['stages']['stage']['p50'], .09)
+        self.assertAlmostEqual(report['stages']['stage']['p95'], .18)
+        self.assertEqual(report['services']['notion'],
+                         {'requests': 2, 'bytes_sent': 10, 'retries': 1})
+
+    def test_paths(self):
+        tracer = Tracer()
+        tracer.enable(profile_cpu=True)
+        dir_temp = Path(mkdtemp())
+        with patch('papnt.trace.TRACER', tracer), \
+             Bench(dir_temp, latency=0., rate_limit_every=5,
+                   notion_rate=0.) as bench:
+            bench.prepare_paths(3)
+            bench.run_paths()
+        tracer.save(dir_temp / 'profile.json', dir_temp / 'profile.pstats')
+        with open(dir_temp / 'profile.json') as f:
+            report = json.load(f)
+        self.assertTrue((dir_temp / 'profile.pstats').exists())
+        shutil.rmtree(dir_temp)
+        for stage in ('pdf2doi', 'metadata', 'crossref', 'upload', 'grobid',
+                      'tei2children', 'notion.create'):
+            self.assertEqual(report['stages'][stage]['count'], 3, stage)
+        notion = report['services']['notion']
+        self.assertGreater(notion['bytes_sent'], 0)
+        self.assertGreater(notion['rate_limited'], 0)
+        self.assertEqual(notion['retries'], notion['rate_limited'])
+        self.assertEqual(report['services']['grobid']['requests'], 3)
+
+
+class TestLazyImport(unittest.TestCase):
+    HEAVY = ('arxiv', 'crossref', 'grobid_client', 'lxml', 'pymupdf',
+             'pdf2doi', 'bibtexparser', 'iso4', 'nltk', 'notion_client',
+             'requests', 'httpx')
+
+    def loaded(self, code: str) -> set:
+        """Top-level packages in HEAVY loaded by code in a fresh python"""
+        code += '; import sys; print("\\n" + " ".join(sys.modules))'
+        result = subprocess.run([sys.executable, '-c', code], check=True,
+                                capture_output=True, text=True)
+        modules = result.stdout.splitlines()[-1].split()  # After output
+        return set(self.HEAVY) & {name.split('.')[0] for name in modules}
+
+    def test_cli(self):
+        self.assertEqual(self.loaded('import papnt.cli'), set())
+        self.assertEqual(self.loaded(
+            'from papnt.cli import main; main(["--help"], standalone_mode='
+            'False)'), set())
+
+    def test_mainfunc(self):
+        self.assertEqual(self.loaded(
+            'import papnt.mainfunc, papnt.mirror, papnt.prop2entry'), set())
+        self.assertEqual(self.loaded(
+            'from papnt.notionprop import CitekeyIndex'), set())
+
+
 if __name__ == '__main__':
     unittest.main()